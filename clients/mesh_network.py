@@ -5,41 +5,278 @@ Creates encrypted P2P connections between peers using STUN hole punching
 
 Features:
 - STUN-based NAT traversal
-- Encrypted communication (Fernet)
+- Encrypted communication (AES-256-GCM)
 - Virtual IP assignment
 - Peer discovery via signaling server
 - Auto-reconnection
 """
 
 import asyncio
+import ctypes
+import ctypes.util
 import socket
 import struct
 import os
 import sys
 import json
 import hashlib
-import base64
+import inspect
 import time
 from datetime import datetime
 from typing import Dict, Optional, Tuple
-from dataclasses import dataclass, asdict
-from cryptography.fernet import Fernet
+from dataclasses import dataclass, field
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+# Optional: orjson encodes straight to bytes and parses several times faster
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode()
+    _loads = json.loads
+
 # Configuration
 STUN_SERVER = "84.247.170.241"
 STUN_PORT = 3478
 MAGIC_COOKIE = 0x2112A442
+NONCE_SIZE = 12  # AES-GCM nonce prepended to every datagram
+TAG_SIZE = 16    # AES-GCM authentication tag appended by the cipher
+SEND_BUF_SIZE = 65536
+
+# cryptography >= 44 can write ciphertext into a caller-supplied buffer
+_HAS_ENCRYPT_INTO = hasattr(AESGCM, 'encrypt_into')
+
+# Precompiled STUN wire formats
+_STUN_HDR = struct.Struct('!HHI')
+_ATTR_HDR = struct.Struct('!HH')
+_U16 = struct.Struct('!H')
+
+# Binding Request header (type, zero length, magic cookie); only the transaction ID varies
+_STUN_BINDING_PREFIX = _STUN_HDR.pack(0x0001, 0, MAGIC_COOKIE)
+
+# Mesh control plane: every decrypted datagram starts with
+# type | node_id | virtual IP, followed by a type-specific body
+MSG_HELLO = 1
+MSG_HELLO_ACK = 2
+MSG_KEEPALIVE = 3
+MSG_DATA = 4
+MSG_DISCOVER = 5
+MSG_DISCOVER_RESPONSE = 6
+MSG_RAW = 7  # body is a 1-byte application tag followed by opaque bytes
+
+_HDR = struct.Struct('!B16s4s')
+_PEER_REC = struct.Struct('!16s4s4sH')  # node_id | virtual IP | external IP | external port
+
+MIN_PACKET_SIZE = NONCE_SIZE + _HDR.size + TAG_SIZE
+
+# sendmmsg(2) / recvmmsg(2) batching (Linux only)
+SENDMMSG_BATCH = 100
+RECVMMSG_BATCH = 32
+RECV_BUF_SIZE = 65536
+
+# Received packets are queued and handled in short batches between yields
+INBOX_SIZE = 1024
+PROCESS_BATCH = 16
+
+# Hello send times (seconds) when hole punching towards a peer
+HOLE_PUNCH_DELAYS = (0, 0.2, 0.5, 1.0, 2.0)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc(name: str, argtypes: list):
+    """Return a libc function, or None where it isn't available"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fn = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = argtypes
+    fn.restype = ctypes.c_int
+    return fn
+
+_libc_sendmmsg = _load_libc('sendmmsg', [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int])
+_libc_recvmmsg = _load_libc('recvmmsg', [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+
+
+def _sockaddr_in(addr: Tuple[str, int]) -> bytes:
+    """Pack (ip, port) as a struct sockaddr_in"""
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', addr[1]) + socket.inet_aton(addr[0]) + bytes(8)
+
+
+def _sendmmsg(fd: int, payload, sockaddrs: list) -> int:
+    """Send one payload to many packed sockaddr_in destinations, one sendmmsg(2)
+    call per batch. Returns the number of datagrams the kernel accepted."""
+    buf = (ctypes.c_char * len(payload)).from_buffer_copy(payload)
+    iov = _IOVec(ctypes.addressof(buf), len(payload))
+    sent = 0
+    for start in range(0, len(sockaddrs), SENDMMSG_BATCH):
+        batch = sockaddrs[start:start + SENDMMSG_BATCH]
+        names = [ctypes.create_string_buffer(a, 16) for a in batch]
+        msgs = (_MMsgHdr * len(batch))()
+        for m, name in zip(msgs, names):
+            m.msg_hdr.msg_name = ctypes.addressof(name)
+            m.msg_hdr.msg_namelen = 16
+            m.msg_hdr.msg_iov = ctypes.pointer(iov)
+            m.msg_hdr.msg_iovlen = 1
+        n = _libc_sendmmsg(fd, msgs, len(batch), 0)
+        if n < 0:
+            break
+        sent += n
+        if n < len(batch):
+            break
+    return sent
+
+
+class _RecvSlots:
+    """Preallocated buffers and headers reused by every recvmmsg(2) call"""
+    
+    def __init__(self, count: int, size: int):
+        self.count = count
+        self.bufs = [ctypes.create_string_buffer(size) for _ in range(count)]
+        self.names = [ctypes.create_string_buffer(16) for _ in range(count)]
+        self.iovs = (_IOVec * count)()
+        self.msgs = (_MMsgHdr * count)()
+        for i in range(count):
+            self.iovs[i].iov_base = ctypes.addressof(self.bufs[i])
+            self.iovs[i].iov_len = size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_namelen = 16
+            hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            hdr.msg_iovlen = 1
+    
+    def recv(self, fd: int) -> list:
+        """Pull up to count datagrams without blocking; returns [(data, addr)]"""
+        n = _libc_recvmmsg(fd, self.msgs, self.count, socket.MSG_DONTWAIT, None)
+        packets = []
+        for i in range(max(n, 0)):
+            msg = self.msgs[i]
+            name = self.names[i].raw
+            addr = (socket.inet_ntoa(name[4:8]), _U16.unpack_from(name, 2)[0])
+            packets.append((ctypes.string_at(self.bufs[i], msg.msg_len), addr))
+            msg.msg_hdr.msg_namelen = 16  # the kernel overwrites it
+        return packets
+
 
-@dataclass
+def _parse_xor_mapped(data: bytes) -> Optional[Tuple[int, int]]:
+    """Walk the STUN attributes and return the decoded XOR-MAPPED-ADDRESS
+    as (ip as int, port), or None if the response doesn't carry one"""
+    mv = memoryview(data)
+    end = min(20 + _U16.unpack_from(mv, 2)[0], len(data))
+    offset = 20
+    while offset + 4 <= end:
+        attr_type, attr_length = _ATTR_HDR.unpack_from(mv, offset)
+        if attr_type == 0x0020 and offset + 12 <= end:  # XOR-MAPPED-ADDRESS
+            return (int.from_bytes(mv[offset + 8:offset + 12], 'big') ^ MAGIC_COOKIE,
+                    int.from_bytes(mv[offset + 6:offset + 8], 'big') ^ (MAGIC_COOKIE >> 16))
+        offset += 4 + ((attr_length + 3) & ~3)
+    return None
+
+
+# PBKDF2 output per (secret, salt, iterations) - derivation is ~50ms of CPU
+_KEY_CACHE: Dict[Tuple[str, bytes, int], bytes] = {}
+
+
+def _derive_key(secret: str, salt: bytes, iterations: int) -> bytes:
+    """Derive a 32-byte key from a shared secret, memoized for the process"""
+    cache_key = (secret, salt, iterations)
+    key = _KEY_CACHE.get(cache_key)
+    if key is None:
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=iterations,
+        )
+        key = _KEY_CACHE[cache_key] = kdf.derive(secret.encode())
+    return key
+
+
+def _unpack_peers(body: bytes) -> list:
+    """Decode a peer table built by MeshNetwork._pack_peers"""
+    count = _U16.unpack_from(body)[0]
+    records = body[_U16.size:_U16.size + count * _PEER_REC.size]
+    return [
+        (node_id.decode(), socket.inet_ntoa(vip), socket.inet_ntoa(ip), port)
+        for node_id, vip, ip, port in _PEER_REC.iter_unpack(records)
+    ]
+
+class MeshProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams from the event loop straight into a MeshNetwork"""
+    
+    def __init__(self, mesh: 'MeshNetwork'):
+        self.mesh = mesh
+    
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        # STUN Binding Response (0x0101) matching an outstanding transaction
+        if data[:2] == b'\x01\x01':
+            fut = self.mesh._stun_pending.get(data[8:20])
+            if fut is not None and not fut.done():
+                fut.set_result(data)
+                return
+        try:
+            self.mesh._inbox.put_nowait((data, addr))
+        except asyncio.QueueFull:
+            pass  # Overloaded - drop it like a full socket buffer would
+
+
+@dataclass(slots=True)
 class Peer:
     peer_id: str
     virtual_ip: str
-    external_ip: str
-    external_port: int
+    addr: Tuple[str, int]
     last_seen: float
     connected: bool = False
+    sockaddr: bytes = field(init=False, repr=False, compare=False)  # packed sockaddr_in for sendmmsg
+    record: bytes = field(init=False, repr=False, compare=False)  # entry for hello_ack/discover_response
+    
+    def __post_init__(self):
+        self.set_addr(self.addr)
+    
+    def set_addr(self, addr: Tuple[str, int]):
+        """Point the peer at a new external address and rebuild its packed forms"""
+        self.addr = addr
+        self.sockaddr = _sockaddr_in(addr)
+        self.record = _PEER_REC.pack(
+            self.peer_id.encode(),
+            socket.inet_aton(self.virtual_ip),
+            self.sockaddr[4:8],
+            addr[1]
+        )
+    
+    @property
+    def external_ip(self) -> str:
+        return self.addr[0]
+    
+    @property
+    def external_port(self) -> int:
+        return self.addr[1]
 
 class MeshNetwork:
     def __init__(self, network_id: str, network_secret: str, local_port: int = 0):
@@ -53,12 +290,30 @@ class MeshNetwork:
         # Derive encryption key from network secret
         self.cipher = self._create_cipher(network_secret)
         
-        # Virtual IP (10.mesh.x.x network)
-        self.virtual_ip = self._generate_virtual_ip()
+        # Virtual IP (10.mesh.x.x network): network byte from the network name,
+        # host bytes from the node ID
+        self._net_hash_byte = hashlib.blake2b(network_id.encode(), digest_size=1).digest()[0]
+        h = hashlib.blake2b(self.node_id.encode(), digest_size=2).digest()
+        self.virtual_ip = f"10.{self._net_hash_byte}.{h[0]}.{h[1]}"
+        
+        # Packed forms used in every control-plane header
+        self.node_id_bytes = self.node_id.encode()
+        self.vip_packed = socket.inet_aton(self.virtual_ip)
+        self._headers = {
+            t: _HDR.pack(t, self.node_id_bytes, self.vip_packed)
+            for t in (MSG_HELLO, MSG_HELLO_ACK, MSG_KEEPALIVE, MSG_DATA, MSG_DISCOVER, MSG_DISCOVER_RESPONSE, MSG_RAW)
+        }
+        
+        # Outgoing datagrams are encrypted in place here: nonce | ciphertext | tag
+        self._send_buf = memoryview(bytearray(SEND_BUF_SIZE))
         
         # Peer management
         self.peers: Dict[str, Peer] = {}
-        self.sock: Optional[socket.socket] = None
+        self._by_vip: Dict[str, Peer] = {}  # virtual_ip -> peer
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._stun_pending: Dict[bytes, asyncio.Future] = {}  # transaction_id -> reply
+        self._inbox: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self.external_ip: Optional[str] = None
         self.external_port: Optional[int] = None
         
@@ -67,44 +322,43 @@ class MeshNetwork:
         self.on_peer_disconnected = None
         self.on_message = None
         
-    def _create_cipher(self, secret: str) -> Fernet:
-        """Create Fernet cipher from network secret"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=b'p2p_mesh_network',
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(secret.encode()))
-        return Fernet(key)
-    
-    def _generate_virtual_ip(self) -> str:
-        """Generate virtual IP from node ID"""
-        # Use hash of node_id to generate consistent IP
-        h = hashlib.md5(self.node_id.encode()).digest()
-        return f"10.{self.network_id_hash()}.{h[0]}.{h[1]}"
-    
-    def network_id_hash(self) -> int:
-        """Get network ID as number for IP generation"""
-        return hashlib.md5(self.network_id.encode()).digest()[0]
+        self._handlers = {
+            MSG_HELLO: self._handle_hello,
+            MSG_HELLO_ACK: self._handle_hello_ack,
+            MSG_KEEPALIVE: self._handle_keepalive,
+            MSG_DATA: self._handle_data,
+            MSG_DISCOVER: self._handle_discover,
+            MSG_RAW: self._handle_raw,
+        }
+        self._raw_handlers: Dict[int, callable] = {}  # tag -> fn(virtual_ip, memoryview)
+        self._app_handlers: Dict[Tuple[str, str], callable] = {}  # (app, type) -> fn(virtual_ip, data)
+        
+    def _create_cipher(self, secret: str) -> AESGCM:
+        """Create AES-GCM cipher from network secret"""
+        return AESGCM(_derive_key(secret, b'p2p_mesh_network', 100000))
     
     def encrypt(self, data: bytes) -> bytes:
         """Encrypt data for network transmission"""
-        return self.cipher.encrypt(data)
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.cipher.encrypt(nonce, data, None)
     
     def decrypt(self, data: bytes) -> bytes:
         """Decrypt data from network"""
-        return self.cipher.decrypt(data)
+        return self.cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None)
     
     async def start(self):
         """Start the mesh network node"""
-        # Create UDP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(('0.0.0.0', self.local_port))
-        self.sock.settimeout(1.0)  # 1 second timeout for recvfrom
+        # Create UDP socket and hand it to the event loop
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', self.local_port))
+        
+        self._loop = asyncio.get_running_loop()
+        self._inbox = asyncio.Queue(maxsize=INBOX_SIZE)
+        self.transport, _ = await self._loop.create_datagram_endpoint(lambda: MeshProtocol(self), sock=sock)
         
-        self.local_port = self.sock.getsockname()[1]
+        self.local_port = sock.getsockname()[1]
+        self._start_batched_recv(self._loop)
         
         # Get external address via STUN
         external = await self._stun_request()
@@ -119,159 +373,164 @@ class MeshNetwork:
         print(f"   External: {self.external_ip}:{self.external_port}")
         
         # Start background tasks
-        asyncio.create_task(self._receive_loop())
+        asyncio.create_task(self._process_loop())
         asyncio.create_task(self._keepalive_loop())
         
+    def _start_batched_recv(self, loop: asyncio.AbstractEventLoop):
+        """On Linux, read with recvmmsg(2) instead of one recvfrom per wakeup"""
+        if _libc_recvmmsg is None or not isinstance(loop, asyncio.SelectorEventLoop):
+            return
+        protocol = self.transport.get_protocol()
+        slots = _RecvSlots(RECVMMSG_BATCH, RECV_BUF_SIZE)
+        # The loop won't register a second reader on a transport's fd, so
+        # read through a duplicate and leave the transport for sending
+        fd = os.dup(self.transport.get_extra_info('socket').fileno())
+        self.transport.pause_reading()
+        
+        def read_ready():
+            for data, addr in slots.recv(fd):
+                protocol.datagram_received(data, addr)
+        
+        loop.add_reader(fd, read_ready)
+    
     async def _stun_request(self) -> Optional[dict]:
         """Get external IP via STUN"""
-        msg_type = 0x0001
         transaction_id = os.urandom(12)
-        header = struct.pack('!HHI', msg_type, 0, MAGIC_COOKIE) + transaction_id
+        header = _STUN_BINDING_PREFIX + transaction_id
         
-        loop = asyncio.get_event_loop()
-        # Use run_in_executor for UDP sendto (works on all platforms)
-        await loop.run_in_executor(None, lambda: self.sock.sendto(header, (STUN_SERVER, STUN_PORT)))
+        # The reply is demultiplexed by transaction ID in MeshProtocol.datagram_received
+        fut = self._loop.create_future()
+        self._stun_pending[transaction_id] = fut
+        self.transport.sendto(header, (STUN_SERVER, STUN_PORT))
         
         try:
-            # Use run_in_executor for UDP recvfrom
-            data, _ = await asyncio.wait_for(
-                loop.run_in_executor(None, lambda: self.sock.recvfrom(1024)), timeout=5
-            )
-            
-            offset = 20
-            msg_length = struct.unpack('!H', data[2:4])[0]
+            data = await asyncio.wait_for(fut, timeout=5)
             
-            while offset < 20 + msg_length:
-                attr_type, attr_length = struct.unpack('!HH', data[offset:offset+4])
-                attr_value = data[offset+4:offset+4+attr_length]
-                
-                if attr_type == 0x0020:  # XOR-MAPPED-ADDRESS
-                    xor_port = struct.unpack('!H', attr_value[2:4])[0] ^ (MAGIC_COOKIE >> 16)
-                    xor_ip = struct.unpack('!I', attr_value[4:8])[0] ^ MAGIC_COOKIE
-                    return {
-                        'ip': socket.inet_ntoa(struct.pack('!I', xor_ip)),
-                        'port': xor_port
-                    }
-                offset += 4 + attr_length + (4 - attr_length % 4) % 4
-        except:
+            mapped = _parse_xor_mapped(data)
+            if mapped:
+                return {
+                    'ip': socket.inet_ntoa(mapped[0].to_bytes(4, 'big')),
+                    'port': mapped[1]
+                }
+        except asyncio.TimeoutError:
             pass
+        finally:
+            self._stun_pending.pop(transaction_id, None)
         return None
     
-    async def _receive_loop(self):
-        """Main receive loop"""
-        loop = asyncio.get_event_loop()
-        
+    async def _process_loop(self):
+        """Drain the inbox, handling up to PROCESS_BATCH packets per scheduler yield"""
+        inbox = self._inbox
         while True:
-            try:
-                # Use run_in_executor for UDP recvfrom (works on all platforms)
-                data, addr = await loop.run_in_executor(None, lambda: self.sock.recvfrom(65535))
-                await self._handle_packet(data, addr)
-            except Exception as e:
-                await asyncio.sleep(0.1)
+            batch = [await inbox.get()]
+            while len(batch) < PROCESS_BATCH and not inbox.empty():
+                batch.append(inbox.get_nowait())
+            
+            for data, addr in batch:
+                try:
+                    await self._handle_packet(data, addr)
+                except Exception as e:
+                    # Authenticated but malformed message, or a failing callback
+                    print(f"⚠️ Error handling packet from {addr[0]}:{addr[1]}: {e}")
+            await asyncio.sleep(0)
     
     async def _handle_packet(self, data: bytes, addr: Tuple[str, int]):
         """Handle incoming packet"""
+        # Too short to be mesh traffic (stray STUN, scans) - skip the decrypt
+        if len(data) < MIN_PACKET_SIZE:
+            return
         try:
-            # Try to decrypt (mesh traffic)
             decrypted = self.decrypt(data)
-            msg = json.loads(decrypted.decode())
-            
-            msg_type = msg.get('type')
-            
-            if msg_type == 'hello':
-                await self._handle_hello(msg, addr)
-            elif msg_type == 'hello_ack':
-                await self._handle_hello_ack(msg, addr)
-            elif msg_type == 'keepalive':
-                await self._handle_keepalive(msg, addr)
-            elif msg_type == 'data':
-                await self._handle_data(msg, addr)
-            elif msg_type == 'discover':
-                await self._handle_discover(msg, addr)
-                
-        except Exception as e:
-            # Not mesh traffic or decryption failed
-            pass
+        except InvalidTag:
+            return  # Not mesh traffic, or another network's key
+        
+        msg_type, node_id, vip = _HDR.unpack_from(decrypted)
+        handler = self._handlers.get(msg_type)
+        if handler:
+            await handler(node_id.decode(), socket.inet_ntoa(vip), decrypted[_HDR.size:], addr)
     
-    async def _handle_hello(self, msg: dict, addr: Tuple[str, int]):
+    async def _handle_hello(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
         """Handle peer hello"""
-        peer_id = msg['node_id']
-        virtual_ip = msg['virtual_ip']
-        
         # Add/update peer
-        self.peers[peer_id] = Peer(
+        peer = Peer(
             peer_id=peer_id,
             virtual_ip=virtual_ip,
-            external_ip=addr[0],
-            external_port=addr[1],
+            addr=addr,
             last_seen=time.time(),
             connected=True
         )
+        self.peers[peer_id] = peer
+        self._by_vip[virtual_ip] = peer
         
         # Send acknowledgment
-        ack = {
-            'type': 'hello_ack',
-            'node_id': self.node_id,
-            'virtual_ip': self.virtual_ip,
-            'peers': [asdict(p) for p in self.peers.values()]
-        }
-        await self._send_to(ack, addr)
+        self._send_to(MSG_HELLO_ACK, self._pack_peers(), addr)
         
         print(f"✅ Peer connected: {virtual_ip} ({peer_id[:8]}...)")
         
         if self.on_peer_connected:
-            self.on_peer_connected(self.peers[peer_id])
+            self.on_peer_connected(peer)
     
-    async def _handle_hello_ack(self, msg: dict, addr: Tuple[str, int]):
+    async def _handle_hello_ack(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
         """Handle hello acknowledgment"""
-        peer_id = msg['node_id']
-        virtual_ip = msg['virtual_ip']
-        
-        self.peers[peer_id] = Peer(
+        peer = Peer(
             peer_id=peer_id,
             virtual_ip=virtual_ip,
-            external_ip=addr[0],
-            external_port=addr[1],
+            addr=addr,
             last_seen=time.time(),
             connected=True
         )
+        self.peers[peer_id] = peer
+        self._by_vip[virtual_ip] = peer
         
-        # Learn about other peers
-        for peer_data in msg.get('peers', []):
-            if peer_data['peer_id'] != self.node_id and peer_data['peer_id'] not in self.peers:
-                # Try to connect to discovered peer
-                asyncio.create_task(self.connect_to_peer(
-                    peer_data['external_ip'],
-                    peer_data['external_port']
-                ))
+        # Learn about other peers and try to connect to them all at once
+        discovered = [
+            (external_ip, external_port)
+            for other_id, _, external_ip, external_port in _unpack_peers(body)
+            if other_id != self.node_id and other_id not in self.peers
+        ]
+        if discovered:
+            asyncio.create_task(self._connect_to_peers(discovered))
         
         print(f"✅ Connected to peer: {virtual_ip} ({peer_id[:8]}...)")
         
         if self.on_peer_connected:
-            self.on_peer_connected(self.peers[peer_id])
+            self.on_peer_connected(peer)
     
-    async def _handle_keepalive(self, msg: dict, addr: Tuple[str, int]):
+    async def _handle_keepalive(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
         """Handle keepalive"""
-        peer_id = msg['node_id']
-        if peer_id in self.peers:
-            self.peers[peer_id].last_seen = time.time()
-            self.peers[peer_id].external_ip = addr[0]
-            self.peers[peer_id].external_port = addr[1]
+        peer = self.peers.get(peer_id)
+        if peer:
+            peer.last_seen = time.time()
+            if peer.addr != addr:
+                peer.set_addr(addr)
     
-    async def _handle_data(self, msg: dict, addr: Tuple[str, int]):
+    async def _handle_data(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
         """Handle data message"""
+        data = _loads(body)
+        if isinstance(data, dict):
+            handler = self._app_handlers.get((data.get('app'), data.get('type')))
+            if handler:
+                result = handler(virtual_ip, data)
+                if inspect.isawaitable(result):
+                    await result
+                return
         if self.on_message:
-            self.on_message(msg.get('from_ip'), msg.get('data'))
+            # Callbacks may be plain functions or coroutine functions
+            result = self.on_message(virtual_ip, data)
+            if inspect.isawaitable(result):
+                await result
+    
+    async def _handle_raw(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
+        """Handle a tagged binary message, bypassing JSON"""
+        handler = self._raw_handlers.get(body[0]) if body else None
+        if handler:
+            result = handler(virtual_ip, memoryview(body)[1:])
+            if inspect.isawaitable(result):
+                await result
     
-    async def _handle_discover(self, msg: dict, addr: Tuple[str, int]):
+    async def _handle_discover(self, peer_id: str, virtual_ip: str, body: bytes, addr: Tuple[str, int]):
         """Handle peer discovery request"""
-        response = {
-            'type': 'discover_response',
-            'node_id': self.node_id,
-            'virtual_ip': self.virtual_ip,
-            'peers': [asdict(p) for p in self.peers.values()]
-        }
-        await self._send_to(response, addr)
+        self._send_to(MSG_DISCOVER_RESPONSE, self._pack_peers(), addr)
     
     async def _keepalive_loop(self):
         """Send keepalives and check peer timeouts"""
@@ -284,67 +543,118 @@ class MeshNetwork:
                 self.external_ip = external['ip']
                 self.external_port = external['port']
             
-            # Send keepalives
-            keepalive = {
-                'type': 'keepalive',
-                'node_id': self.node_id,
-                'virtual_ip': self.virtual_ip
-            }
-            
+            alive = []
             for peer_id, peer in list(self.peers.items()):
                 if time.time() - peer.last_seen > 60:
                     # Peer timeout
                     print(f"❌ Peer disconnected: {peer.virtual_ip}")
                     if self.on_peer_disconnected:
                         self.on_peer_disconnected(peer)
+                    self._by_vip.pop(peer.virtual_ip, None)
                     del self.peers[peer_id]
                 else:
-                    await self._send_to(keepalive, (peer.external_ip, peer.external_port))
+                    alive.append(peer)
+            
+            # Send keepalives (same ciphertext for every peer). Sealed only now: the
+            # disconnect callbacks above may send, reusing the shared send buffer
+            if alive:
+                self._send_many(self._seal(MSG_KEEPALIVE), alive)
+    
+    def _pack_peers(self) -> bytes:
+        """Encode the peer table as a count-prefixed run of peer records"""
+        return _U16.pack(len(self.peers)) + b''.join(p.record for p in self.peers.values())
+    
+    def _seal(self, msg_type: int, *body) -> memoryview:
+        """Frame and encrypt a message into the shared send buffer. The body may
+        be given in several parts (any buffers), joined with a single copy.
+        The returned view is only valid until the next _seal() call."""
+        plaintext = b''.join((self._headers[msg_type], *body))
+        size = NONCE_SIZE + len(plaintext) + TAG_SIZE
+        if not _HAS_ENCRYPT_INTO or size > SEND_BUF_SIZE:
+            return memoryview(self.encrypt(plaintext))
+        
+        nonce = os.urandom(NONCE_SIZE)
+        out = self._send_buf[:size]
+        out[:NONCE_SIZE] = nonce
+        self.cipher.encrypt_into(nonce, plaintext, None, out[NONCE_SIZE:])
+        return out
+    
+    def _retire_send_buf(self):
+        """uvloop queues a datagram it can't send at once by reference, not by copy:
+        if anything is queued, leave the old send buffer to it and seal into a new one"""
+        if self.transport.get_write_buffer_size():
+            self._send_buf = memoryview(bytearray(SEND_BUF_SIZE))
     
-    async def _send_to(self, msg: dict, addr: Tuple[str, int]):
+    def _send_to(self, msg_type: int, body: bytes, addr: Tuple[str, int]):
         """Send encrypted message to address"""
-        data = json.dumps(msg).encode()
-        encrypted = self.encrypt(data)
-        loop = asyncio.get_event_loop()
-        # Use run_in_executor for UDP sendto (works on all platforms)
-        await loop.run_in_executor(None, lambda: self.sock.sendto(encrypted, addr))
+        self.transport.sendto(self._seal(msg_type, body), addr)
+        self._retire_send_buf()
+    
+    async def _send_after(self, delay: float, msg_type: int, addr: Tuple[str, int]):
+        """Send a bodiless message after a delay"""
+        await asyncio.sleep(delay)
+        self._send_to(msg_type, b'', addr)
     
     async def connect_to_peer(self, ip: str, port: int):
         """Initiate connection to a peer"""
-        hello = {
-            'type': 'hello',
-            'node_id': self.node_id,
-            'virtual_ip': self.virtual_ip,
-            'network_id': self.network_id
-        }
-        
-        # Send multiple hello packets (hole punching)
-        for _ in range(5):
-            await self._send_to(hello, (ip, port))
-            await asyncio.sleep(0.5)
+        # Send multiple hello packets on a staggered schedule (hole punching)
+        await asyncio.gather(*(
+            self._send_after(delay, MSG_HELLO, (ip, port)) for delay in HOLE_PUNCH_DELAYS
+        ))
+    
+    async def _connect_to_peers(self, addrs: list):
+        """Hole punch towards several peers concurrently"""
+        await asyncio.gather(*(self.connect_to_peer(ip, port) for ip, port in addrs))
     
     async def send(self, virtual_ip: str, data: any):
         """Send data to a peer by virtual IP"""
-        for peer in self.peers.values():
-            if peer.virtual_ip == virtual_ip:
-                msg = {
-                    'type': 'data',
-                    'from_ip': self.virtual_ip,
-                    'data': data
-                }
-                await self._send_to(msg, (peer.external_ip, peer.external_port))
-                return True
+        peer = self._by_vip.get(virtual_ip)
+        if peer:
+            self._send_to(MSG_DATA, _dumps(data), peer.addr)
+            return True
+        return False
+    
+    async def send_raw(self, virtual_ip: str, tag: int, *payload):
+        """Send tagged binary data to a peer by virtual IP. The payload may be
+        given in several parts (bytes or memoryviews) to avoid joining them first."""
+        return self.send_raw_nowait(virtual_ip, tag, *payload)
+    
+    def send_raw_nowait(self, virtual_ip: str, tag: int, *payload) -> bool:
+        """send_raw() for synchronous callers such as raw handlers (sending never blocks)"""
+        peer = self._by_vip.get(virtual_ip)
+        if peer:
+            self.transport.sendto(self._seal(MSG_RAW, bytes((tag,)), *payload), peer.addr)
+            self._retire_send_buf()
+            return True
         return False
     
+    def register_handler(self, app: str, msg_type: str, handler):
+        """Route messages whose 'app' and 'type' match to handler(virtual_ip, data)
+        instead of on_message"""
+        self._app_handlers[(app, msg_type)] = handler
+    
+    def register_raw_handler(self, tag: int, handler):
+        """Route MSG_RAW messages carrying tag to handler(virtual_ip, payload)"""
+        self._raw_handlers[tag] = handler
+    
     async def broadcast(self, data: any):
         """Broadcast data to all peers"""
-        msg = {
-            'type': 'data',
-            'from_ip': self.virtual_ip,
-            'data': data
-        }
-        for peer in self.peers.values():
-            await self._send_to(msg, (peer.external_ip, peer.external_port))
+        # All peers share the network key, so one ciphertext serves everyone
+        encrypted = self._seal(MSG_DATA, _dumps(data))
+        self._send_many(encrypted, list(self.peers.values()))
+    
+    def _send_many(self, encrypted: memoryview, peers: list):
+        """Send one encrypted payload to many peers"""
+        if not peers:
+            return
+        sent = 0
+        if _libc_sendmmsg:
+            sent = _sendmmsg(self.transport.get_extra_info('socket').fileno(), encrypted,
+                             [p.sockaddr for p in peers])
+        # Fallback (non-Linux) and anything the kernel didn't take
+        for peer in peers[sent:]:
+            self.transport.sendto(encrypted, peer.addr)
+        self._retire_send_buf()
     
     def get_peers(self) -> list:
         """Get list of connected peers"""
@@ -388,7 +698,7 @@ async def main():
     print("-" * 50)
     
     # Chat loop
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     while True:
         try:
             print("You: ", end="", flush=True)
@@ -21,18 +21,23 @@ STUN_SERVER = "84.247.170.241"
 STUN_PORT = 3478
 MAGIC_COOKIE = 0x2112A442
 
+# Precompiled STUN wire formats
+_STUN_HDR = struct.Struct('!HHI')
+_ATTR_HDR = struct.Struct('!HH')
+
+# Binding Request header (type, zero length, magic cookie); only the transaction ID varies
+_STUN_BINDING_PREFIX = _STUN_HDR.pack(0x0001, 0, MAGIC_COOKIE)
+
 def create_stun_request():
-    msg_type = 0x0001  # Binding Request
-    msg_length = 0
     transaction_id = os.urandom(12)
-    header = struct.pack('!HHI', msg_type, msg_length, MAGIC_COOKIE) + transaction_id
-    return header, transaction_id
+    return _STUN_BINDING_PREFIX + transaction_id, transaction_id
 
 def parse_stun_response(data, transaction_id):
     if len(data) < 20:
         return None
     
-    msg_type, msg_length, magic = struct.unpack('!HHI', data[:8])
+    mv = memoryview(data)
+    msg_type, msg_length, magic = _STUN_HDR.unpack_from(mv)
     if data[8:20] != transaction_id:
         return None
     
@@ -41,29 +46,56 @@ def parse_stun_response(data, transaction_id):
     while offset < 20 + msg_length:
         if offset + 4 > len(data):
             break
-        attr_type, attr_length = struct.unpack('!HH', data[offset:offset+4])
-        attr_value = data[offset+4:offset+4+attr_length]
+        attr_type, attr_length = _ATTR_HDR.unpack_from(mv, offset)
         
-        if attr_type == 0x0020:  # XOR-MAPPED-ADDRESS
-            xor_port = struct.unpack('!H', attr_value[2:4])[0] ^ (MAGIC_COOKIE >> 16)
-            xor_ip = struct.unpack('!I', attr_value[4:8])[0] ^ MAGIC_COOKIE
-            result['ip'] = socket.inet_ntoa(struct.pack('!I', xor_ip))
+        if attr_type == 0x0020 and offset + 12 <= len(data):  # XOR-MAPPED-ADDRESS
+            xor_port = int.from_bytes(mv[offset + 6:offset + 8], 'big') ^ (MAGIC_COOKIE >> 16)
+            xor_ip = int.from_bytes(mv[offset + 8:offset + 12], 'big') ^ MAGIC_COOKIE
+            result['ip'] = socket.inet_ntoa(xor_ip.to_bytes(4, 'big'))
             result['port'] = xor_port
         
-        offset += 4 + attr_length + (4 - attr_length % 4) % 4
+        offset += 4 + ((attr_length + 3) & ~3)
     
     return result
 
-async def get_external_address(sock):
+class UDPEndpoint(asyncio.DatagramProtocol):
+    """UDP endpoint driven by the event loop; received datagrams are queued"""
+    
+    def __init__(self):
+        self.transport = None
+        self.queue = asyncio.Queue()
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((data, addr))
+    
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+    
+    async def recvfrom(self):
+        return await self.queue.get()
+
+async def open_endpoint(local_port):
+    """Bind a UDP socket on local_port and attach it to the event loop"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', local_port))
+    
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(UDPEndpoint, sock=sock)
+    return endpoint
+
+async def get_external_address(endpoint):
     """Get external IP and port via STUN"""
     request, transaction_id = create_stun_request()
     
-    loop = asyncio.get_event_loop()
-    await loop.sock_sendto(sock, request, (STUN_SERVER, STUN_PORT))
+    endpoint.sendto(request, (STUN_SERVER, STUN_PORT))
     
     try:
         data, _ = await asyncio.wait_for(
-            loop.sock_recvfrom(sock, 1024),
+            endpoint.recvfrom(),
             timeout=5
         )
         return parse_stun_response(data, transaction_id)
@@ -75,17 +107,14 @@ async def run_server_mode(local_port):
     print(f"\n🚀 P2P STUN Test - SERVER MODE")
     print("=" * 50)
     
-    # Create UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('0.0.0.0', local_port))
-    sock.setblocking(False)
+    # Create UDP endpoint
+    endpoint = await open_endpoint(local_port)
     
     print(f"✅ Listening on local port: {local_port}")
     
     # Get external address via STUN
     print(f"🔍 Contacting STUN server: {STUN_SERVER}:{STUN_PORT}")
-    external = await get_external_address(sock)
+    external = await get_external_address(endpoint)
     
     if not external:
         print("❌ Failed to get external address from STUN")
@@ -101,15 +130,13 @@ async def run_server_mode(local_port):
     print(f"\n⏳ Waiting for peer connection...")
     print("-" * 50)
     
-    loop = asyncio.get_event_loop()
-    
     # Keep refreshing STUN binding and wait for peer
     while True:
         try:
             # Refresh STUN binding every 25 seconds
             refresh_task = asyncio.create_task(asyncio.sleep(25))
             recv_task = asyncio.create_task(
-                asyncio.wait_for(loop.sock_recvfrom(sock, 1024), timeout=30)
+                asyncio.wait_for(endpoint.recvfrom(), timeout=30)
             )
             
             done, pending = await asyncio.wait(
@@ -131,12 +158,12 @@ async def run_server_mode(local_port):
                         
                         # Send response
                         response = f"ACK:Server-{datetime.now().strftime('%H:%M:%S')}"
-                        await loop.sock_sendto(sock, response.encode(), addr)
+                        endpoint.sendto(response.encode(), addr)
                         print(f"✅ Sent acknowledgment to peer")
                         
                         # Chat mode
                         print(f"\n💬 Chat mode (type messages, Ctrl+C to exit):")
-                        await chat_loop(sock, addr)
+                        await chat_loop(endpoint, addr)
                         break
                     else:
                         print(f"📨 Received from {addr}: {msg}")
@@ -144,7 +171,7 @@ async def run_server_mode(local_port):
                     pass
             else:
                 # Refresh STUN binding
-                await get_external_address(sock)
+                await get_external_address(endpoint)
                 print(".", end="", flush=True)
                 
         except Exception as e:
@@ -155,35 +182,31 @@ async def run_client_mode(peer_ip, peer_port, local_port):
     print(f"\n🚀 P2P STUN Test - CLIENT MODE")
     print("=" * 50)
     
-    # Create UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('0.0.0.0', local_port))
-    sock.setblocking(False)
+    # Create UDP endpoint
+    endpoint = await open_endpoint(local_port)
     
     print(f"✅ Local port: {local_port}")
     
     # Get our external address
     print(f"🔍 Getting external address via STUN...")
-    external = await get_external_address(sock)
+    external = await get_external_address(endpoint)
     
     if external:
         print(f"   Our external: {external['ip']}:{external['port']}")
     
     print(f"\n🔗 Connecting to peer: {peer_ip}:{peer_port}")
     
-    loop = asyncio.get_event_loop()
     peer_addr = (peer_ip, peer_port)
     
     # Send connection attempts (hole punching)
     for attempt in range(10):
         msg = f"HELLO:Client-{datetime.now().strftime('%H:%M:%S')}"
-        await loop.sock_sendto(sock, msg.encode(), peer_addr)
+        endpoint.sendto(msg.encode(), peer_addr)
         print(f"   Attempt {attempt + 1}/10 - Sent HELLO")
         
         try:
             data, addr = await asyncio.wait_for(
-                loop.sock_recvfrom(sock, 1024),
+                endpoint.recvfrom(),
                 timeout=2
             )
             msg = data.decode('utf-8', errors='ignore')
@@ -193,7 +216,7 @@ async def run_client_mode(peer_ip, peer_port, local_port):
                 
                 # Chat mode
                 print(f"\n💬 Chat mode (type messages, Ctrl+C to exit):")
-                await chat_loop(sock, addr)
+                await chat_loop(endpoint, addr)
                 return True
                 
         except asyncio.TimeoutError:
@@ -206,14 +229,14 @@ async def run_client_mode(peer_ip, peer_port, local_port):
     print("   - Incorrect peer address")
     return False
 
-async def chat_loop(sock, peer_addr):
+async def chat_loop(endpoint, peer_addr):
     """Simple chat between peers"""
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     
     async def receive_messages():
         while True:
             try:
-                data, addr = await loop.sock_recvfrom(sock, 1024)
+                data, addr = await endpoint.recvfrom()
                 msg = data.decode('utf-8', errors='ignore')
                 print(f"\n📨 Peer: {msg}")
                 print("You: ", end="", flush=True)
@@ -230,7 +253,7 @@ async def chat_loop(sock, peer_addr):
             msg = await loop.run_in_executor(None, input)
             if msg.lower() in ('quit', 'exit', 'q'):
                 break
-            await loop.sock_sendto(sock, msg.encode(), peer_addr)
+            endpoint.sendto(msg.encode(), peer_addr)
     except KeyboardInterrupt:
         pass
     finally:
@@ -7,14 +7,132 @@ Share files directly with friends without a server!
 import asyncio
 import os
 import sys
-import json
-import base64
 import hashlib
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from mesh_network import MeshNetwork
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+from dataclasses import dataclass, field
+
+# Optional: pybase64 decodes with SIMD, for chunks from peers on the JSON format
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
 
 CHUNK_SIZE = 32000  # ~32KB chunks (fits in UDP packet after encryption)
+READ_AHEAD = 32  # chunks read from disk ahead of the sender
+
+# File chunks travel as raw mesh messages: file_id | chunk_num | is_last | data
+RAW_FILE_CHUNK = 1
+FILE_CHUNK_FRAME = struct.Struct('<16sIB')
+# and every chunk is acknowledged with file_id | chunk_num
+RAW_FILE_ACK = 2
+FILE_ACK_FRAME = struct.Struct('<16sI')
+
+# Sliding send window, in chunks: grows by one per window of acks,
+# halves when acks stop arriving (AIMD)
+INITIAL_WINDOW = 32
+MIN_WINDOW = 4
+MAX_WINDOW = 512
+ACK_TIMEOUT = 1.0  # seconds before an unacknowledged chunk is resent
+MAX_STALLS = 10  # consecutive timeouts without any ack before giving up
+
+_HAS_PREADV = hasattr(os, 'preadv')  # POSIX only
+_HAS_PWRITE = hasattr(os, 'pwrite')
+HASH_READ_SIZE = 1 << 20
+IO_WORKERS = 4  # disk reads in flight, shared by every transfer
+COMPLETED_CACHE = 256  # finished downloads remembered, so repeat offers are skipped
+
+
+def _file_id(path: Path) -> str:
+    """Content-derived file ID: the same file always gets the same ID"""
+    h = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(HASH_READ_SIZE)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _read_at(f, buf: bytearray, offset: int) -> int:
+    """Fill buf from offset in f, returning the byte count"""
+    if _HAS_PREADV:
+        return os.preadv(f.fileno(), [buf], offset)
+    f.seek(offset)
+    return f.readinto(buf)
+
+
+def _write_at(fd: int, data, offset: int):
+    """Write data at offset in fd"""
+    if _HAS_PWRITE:
+        os.pwrite(fd, data, offset)
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def _has_chunk(bitmap: bytes, chunk_num: int) -> bool:
+    """Test a chunk's bit in a one-bit-per-chunk bitmap"""
+    byte = chunk_num >> 3
+    return byte < len(bitmap) and bool(bitmap[byte] & (1 << (chunk_num & 7)))
+
+
+def _read_chunk(path: str, chunk_num: int) -> bytes:
+    """Read one chunk through its own handle (resends run alongside the reader)"""
+    with open(path, 'rb') as f:
+        f.seek(chunk_num * CHUNK_SIZE)
+        return f.read(CHUNK_SIZE)
+
+
+@dataclass(slots=True)
+class IncomingFile:
+    """A file offered by a peer, and the chunks received so far"""
+    from_ip: str
+    name: str
+    size: int
+    total_chunks: int
+    part_path: Optional[Path] = None  # chunks are written here as they arrive
+    fd: Optional[int] = field(default=None, repr=False)  # open once requested
+    have: Optional[bytearray] = field(default=None, repr=False)  # one bit per chunk
+    received: int = 0
+    
+    def begin(self, part_path: Path):
+        """Create the full-size partial file and the chunk bitmap"""
+        self.part_path = part_path
+        self.fd = os.open(part_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        os.ftruncate(self.fd, self.size)
+        self.have = bytearray((self.total_chunks + 7) // 8)
+        self.received = 0
+    
+    def close(self):
+        """Release the partial file's descriptor"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+@dataclass(slots=True)
+class SendWindow:
+    """Chunks in flight to one peer for one file"""
+    size: float = INITIAL_WINDOW
+    inflight: Dict[int, float] = field(default_factory=dict)  # chunk_num -> last send time
+    acked: asyncio.Event = field(default_factory=asyncio.Event)
+    stalls: int = 0
+    
+    def ack(self, chunk_num: int):
+        if self.inflight.pop(chunk_num, None) is not None:
+            self.size = min(self.size + 1 / self.size, MAX_WINDOW)
+            self.stalls = 0
+            self.acked.set()
+    
+    def backoff(self):
+        self.size = max(self.size / 2, MIN_WINDOW)
+        self.stalls += 1
 
 
 class P2PFileShare:
@@ -24,27 +142,37 @@ class P2PFileShare:
         self.download_dir.mkdir(exist_ok=True)
         
         # Track ongoing transfers
-        self.incoming: Dict[str, dict] = {}  # file_id -> {chunks, total, name, size}
+        self.incoming: Dict[str, IncomingFile] = {}
         self.shared_files: Dict[str, str] = {}  # file_id -> path
+        self._windows: Dict[Tuple[str, bytes], SendWindow] = {}  # (peer, file_id) -> outgoing window
+        self._transfers: Dict[Tuple[str, bytes], asyncio.Task] = {}  # (peer, file_id) -> sending task
+        self._completed: OrderedDict[str, Path] = OrderedDict()  # file_id -> saved path, LRU
+        
+        # Disk I/O gets its own threads so it never queues behind input() or other blocking calls
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='fs-io')
         
-        # Override message handler
-        self._original_handler = mesh.on_message
-        mesh.on_message = self._handle_message
+        mesh.register_handler('fileshare', 'file_offer', self._on_file_offer)
+        mesh.register_handler('fileshare', 'file_request', self._start_file_request)
+        mesh.register_handler('fileshare', 'file_chunk', self._on_file_chunk)
+        mesh.register_handler('fileshare', 'file_list', self._on_file_list)
+        mesh.register_raw_handler(RAW_FILE_CHUNK, self._on_file_chunk_bin)
+        mesh.register_raw_handler(RAW_FILE_ACK, self._on_file_ack)
     
-    def _handle_message(self, from_ip: str, data):
-        if isinstance(data, dict) and data.get('app') == 'fileshare':
-            msg_type = data.get('type')
-            
-            if msg_type == 'file_offer':
-                self._on_file_offer(from_ip, data)
-            elif msg_type == 'file_request':
-                asyncio.create_task(self._on_file_request(from_ip, data))
-            elif msg_type == 'file_chunk':
-                self._on_file_chunk(from_ip, data)
-            elif msg_type == 'file_list':
-                self._on_file_list(from_ip, data)
-        elif self._original_handler:
-            self._original_handler(from_ip, data)
+    def _start_file_request(self, from_ip: str, data: dict):
+        file_id = data.get('file_id')
+        if file_id not in self.shared_files:
+            return
+        # A repeat request (retry or resume) supersedes the transfer already running
+        key = (from_ip, file_id.encode())
+        running = self._transfers.get(key)
+        if running:
+            running.cancel()
+        task = self._transfers[key] = asyncio.create_task(self._on_file_request(from_ip, data))
+        
+        def forget(t):
+            if self._transfers.get(key) is t:
+                del self._transfers[key]
+        task.add_done_callback(forget)
     
     async def share_file(self, filepath: str):
         """Share a file with all peers"""
@@ -53,7 +181,8 @@ class P2PFileShare:
             print(f"❌ File not found: {filepath}")
             return
         
-        file_id = hashlib.md5(f"{path.name}{path.stat().st_size}{os.urandom(4).hex()}".encode()).hexdigest()[:16]
+        # Hash in the executor - large files would otherwise stall the event loop
+        file_id = await asyncio.get_running_loop().run_in_executor(self._io_pool, _file_id, path)
         self.shared_files[file_id] = str(path.absolute())
         
         # Broadcast file offer
@@ -74,19 +203,35 @@ class P2PFileShare:
         name = data.get('name')
         size = data.get('size')
         
+        # IDs are content hashes, so a known ID means we already have these bytes
+        saved = self._completed.get(file_id)
+        if saved is not None and saved.exists():
+            self._completed.move_to_end(file_id)
+            print(f"\n📥 {from_ip} offered {name} - already downloaded to {saved}")
+            return
+
+        # Keep a partial download; a resume goes to whoever offered it last
+        current = self.incoming.get(file_id)
+        if current is not None and current.fd is not None:
+            current.from_ip = from_ip
+            print(f"\n📥 {from_ip} offered {name} - {current.received}/{current.total_chunks} chunks already here")
+            print(f"   To resume: /download {file_id}")
+            return
+
         print(f"\n📥 File offered from {from_ip}:")
         print(f"   Name: {name}")
         print(f"   Size: {self._format_size(size)}")
         print(f"   To download: /download {file_id}")
         
         # Store offer info
-        self.incoming[file_id] = {
-            'from': from_ip,
-            'name': name,
-            'size': size,
-            'chunks': {},
-            'total_chunks': (size + CHUNK_SIZE - 1) // CHUNK_SIZE
-        }
+        if current is not None:
+            current.close()
+        self.incoming[file_id] = IncomingFile(
+            from_ip=from_ip,
+            name=name,
+            size=size,
+            total_chunks=(size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        )
     
     async def request_file(self, file_id: str):
         """Request a file from peer"""
@@ -95,14 +240,20 @@ class P2PFileShare:
             return
         
         info = self.incoming[file_id]
-        print(f"⬇️ Requesting: {info['name']}...")
-        
-        # Request file
-        await self.mesh.send(info['from'], {
+        request = {
             'app': 'fileshare',
             'type': 'file_request',
             'file_id': file_id
-        })
+        }
+        if info.fd is None:
+            print(f"⬇️ Requesting: {info.name}...")
+            info.begin(self.download_dir / f"{info.name}.part")
+        else:
+            # Resuming: only ask for the chunks still missing
+            print(f"⬇️ Resuming: {info.name} ({info.received}/{info.total_chunks} chunks)...")
+            request['have'] = info.have.hex()
+        
+        await self.mesh.send(info.from_ip, request)
     
     async def _on_file_request(self, from_ip: str, data: dict):
         """Handle file request - send file chunks"""
@@ -112,64 +263,165 @@ class P2PFileShare:
             return
         
         filepath = self.shared_files[file_id]
+        have = bytes.fromhex(data.get('have', ''))  # chunks the requester already holds
         print(f"📤 Sending file to {from_ip}...")
         
+        # Disk reads run in the executor and stay ahead of the sender
+        queue = asyncio.Queue(maxsize=READ_AHEAD)
         with open(filepath, 'rb') as f:
-            chunk_num = 0
+            reader = asyncio.create_task(self._read_chunks(f, file_id.encode(), queue, have))
+            try:
+                chunk_num = await self._send_chunks(from_ip, file_id, filepath, queue)
+            except TimeoutError as e:
+                print(f"❌ Transfer to {from_ip} failed: {e}")
+                return
+            finally:
+                reader.cancel()
+        
+        print(f"✅ File sent: {chunk_num} chunks")
+    
+    async def _read_chunks(self, f, file_id: bytes, queue: asyncio.Queue, have: bytes = b''):
+        """Feed (chunk_num, frame) into queue. Each frame is a view of a reused slot
+        holding the frame header followed by the chunk read straight in after it.
+        Chunks set in the have bitmap are skipped; a short (possibly empty) chunk marks the end."""
+        loop = asyncio.get_running_loop()
+        hdr = FILE_CHUNK_FRAME.size
+        # Enough slots for a full queue plus the chunk being sent and the one being read
+        ring = [memoryview(bytearray(hdr + CHUNK_SIZE)) for _ in range(READ_AHEAD + 2)]
+        reads = 0
+        chunk_num = 0
+        while True:
+            if _has_chunk(have, chunk_num):
+                chunk_num += 1
+                continue
+            slot = ring[reads % len(ring)]
+            n = await loop.run_in_executor(self._io_pool, _read_at, f, slot[hdr:], chunk_num * CHUNK_SIZE)
+            FILE_CHUNK_FRAME.pack_into(slot, 0, file_id, chunk_num, n < CHUNK_SIZE)
+            await queue.put((chunk_num, slot[:hdr + n]))
+            if n < CHUNK_SIZE:
+                return
+            reads += 1
+            chunk_num += 1
+    
+    async def _send_chunks(self, from_ip: str, file_id: str, filepath: str, queue: asyncio.Queue) -> int:
+        """Send chunks from queue as binary frames, keeping at most a window's worth
+        unacknowledged. Returns how many chunks were sent once all are acknowledged."""
+        file_id_bytes = file_id.encode()
+        key = (from_ip, file_id_bytes)
+        window = self._windows[key] = SendWindow()
+        sent = 0
+        try:
             while True:
-                chunk = f.read(CHUNK_SIZE)
-                if not chunk:
+                chunk_num, frame = await queue.get()
+                size = len(frame) - FILE_CHUNK_FRAME.size
+                if size:
+                    while len(window.inflight) >= window.size:
+                        await self._await_acks(from_ip, file_id_bytes, filepath, window)
+                    await self._send_frame(from_ip, chunk_num, window, frame)
+                    sent += 1
+                if size < CHUNK_SIZE:
                     break
-                
-                await self.mesh.send(from_ip, {
-                    'app': 'fileshare',
-                    'type': 'file_chunk',
-                    'file_id': file_id,
-                    'chunk_num': chunk_num,
-                    'data': base64.b64encode(chunk).decode(),
-                    'is_last': len(chunk) < CHUNK_SIZE
-                })
-                
-                chunk_num += 1
-                await asyncio.sleep(0.01)  # Small delay to not overwhelm
+            while window.inflight:
+                await self._await_acks(from_ip, file_id_bytes, filepath, window)
+        finally:
+            if self._windows.get(key) is window:
+                del self._windows[key]
+        return sent
+    
+    async def _send_frame(self, from_ip: str, chunk_num: int, window: SendWindow, *frame):
+        window.inflight[chunk_num] = time.monotonic()
+        await self.mesh.send_raw(from_ip, RAW_FILE_CHUNK, *frame)
+    
+    async def _await_acks(self, from_ip: str, file_id: bytes, filepath: str, window: SendWindow):
+        """Wait for the window to move; on timeout shrink it and resend overdue chunks"""
+        window.acked.clear()
+        try:
+            await asyncio.wait_for(window.acked.wait(), ACK_TIMEOUT)
+            return
+        except asyncio.TimeoutError:
+            pass
         
-        print(f"✅ File sent: {chunk_num} chunks")
+        window.backoff()
+        if window.stalls > MAX_STALLS:
+            raise TimeoutError(f"no acknowledgements for {MAX_STALLS * ACK_TIMEOUT:.0f}s")
+        
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        overdue = [n for n, sent in window.inflight.items() if now - sent >= ACK_TIMEOUT]
+        for n in overdue[:int(window.size)]:
+            chunk = await loop.run_in_executor(self._io_pool, _read_chunk, filepath, n)
+            header = FILE_CHUNK_FRAME.pack(file_id, n, len(chunk) < CHUNK_SIZE)
+            await self._send_frame(from_ip, n, window, header, chunk)
+    
+    def _on_file_ack(self, from_ip: str, frame: memoryview):
+        """Handle a chunk acknowledgement for an outgoing transfer"""
+        file_id, chunk_num = FILE_ACK_FRAME.unpack_from(frame)
+        window = self._windows.get((from_ip, file_id))
+        if window:
+            window.ack(chunk_num)
     
     def _on_file_chunk(self, from_ip: str, data: dict):
-        """Handle incoming file chunk"""
-        file_id = data.get('file_id')
-        chunk_num = data.get('chunk_num')
-        chunk_data = base64.b64decode(data.get('data'))
-        is_last = data.get('is_last', False)
-        
-        if file_id not in self.incoming:
+        """Handle incoming file chunk (JSON/base64, from older peers)"""
+        self._store_chunk(
+            data.get('file_id'),
+            data.get('chunk_num'),
+            b64decode(data.get('data'))
+        )
+    
+    def _on_file_chunk_bin(self, from_ip: str, frame: memoryview):
+        """Handle incoming binary file chunk"""
+        file_id, chunk_num, _ = FILE_CHUNK_FRAME.unpack_from(frame)
+        # Ack even duplicates and finished files - the earlier ack may have been lost
+        self.mesh.send_raw_nowait(from_ip, RAW_FILE_ACK, FILE_ACK_FRAME.pack(file_id, chunk_num))
+        self._store_chunk(file_id.decode(), chunk_num, frame[FILE_CHUNK_FRAME.size:])
+    
+    def _store_chunk(self, file_id: str, chunk_num: int, chunk_data: bytes):
+        """Record a received chunk and save the file once it's complete"""
+        info = self.incoming.get(file_id)
+        if info is None or info.fd is None or not 0 <= chunk_num < info.total_chunks:
             return
         
-        info = self.incoming[file_id]
-        info['chunks'][chunk_num] = chunk_data
+        offset = chunk_num * CHUNK_SIZE
+        if len(chunk_data) != min(CHUNK_SIZE, info.size - offset):
+            return  # malformed
+        
+        byte, mask = chunk_num >> 3, 1 << (chunk_num & 7)
+        if not info.have[byte] & mask:
+            _write_at(info.fd, chunk_data, offset)
+            info.have[byte] |= mask
+            info.received += 1
         
         # Progress
-        received = len(info['chunks'])
-        total = info['total_chunks']
+        received = info.received
+        total = info.total_chunks
         pct = (received / total) * 100 if total > 0 else 0
-        print(f"\r⬇️ Downloading {info['name']}: {pct:.1f}% ({received}/{total})", end='')
+        print(f"\r⬇️ Downloading {info.name}: {pct:.1f}% ({received}/{total})", end='')
         
-        # Check if complete
-        if is_last or received >= total:
+        # Check if complete (chunks can arrive out of order once resent)
+        if received >= total:
             self._save_file(file_id)
     
     def _save_file(self, file_id: str):
         """Save completed file"""
         info = self.incoming[file_id]
-        filepath = self.download_dir / info['name']
+        filepath = self.download_dir / info.name
         
-        # Sort chunks and write
-        with open(filepath, 'wb') as f:
-            for i in sorted(info['chunks'].keys()):
-                f.write(info['chunks'][i])
+        # Every chunk is already on disk
+        info.close()
+        os.replace(info.part_path, filepath)
         
         print(f"\n✅ Downloaded: {filepath}")
         del self.incoming[file_id]
+        
+        self._completed[file_id] = filepath
+        if len(self._completed) > COMPLETED_CACHE:
+            self._completed.popitem(last=False)
+    
+    def close(self):
+        """Release the descriptors of unfinished downloads"""
+        for info in self.incoming.values():
+            info.close()
+        self._io_pool.shutdown(wait=False)
     
     async def list_shared(self):
         """List all shared files"""
@@ -240,10 +492,11 @@ async def main():
     print("  /quit              - Exit")
     print("="*50)
     
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    ui_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ui')
     while True:
         try:
-            cmd = await loop.run_in_executor(None, input, "\n> ")
+            cmd = await loop.run_in_executor(ui_pool, input, "\n> ")
             
             if cmd.startswith('/share '):
                 path = cmd.split(' ', 1)[1].strip()
@@ -272,6 +525,7 @@ async def main():
         except Exception as e:
             print(f"Error: {e}")
     
+    fs.close()
     print("\n👋 Goodbye!")
 
 
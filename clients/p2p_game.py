@@ -9,13 +9,19 @@ Examples included:
 - Drawing Canvas
 """
 
+import array
 import asyncio
-import json
+import functools
 import time
 import random
+from concurrent.futures import ThreadPoolExecutor
 from mesh_network import MeshNetwork
 from typing import Dict, List, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
+
+# Moves made within BATCH_DELAY seconds go out together in one game_batch message
+BATCH_DELAY = 0.02
+BATCH_MAX_OPS = 256  # flush early so a batch stays well inside one datagram
 
 
 @dataclass
@@ -28,36 +34,80 @@ class GameState:
     finished: bool = False
 
 
+class MoveBatcher:
+    """Coalesces rapid-fire moves into a single game_batch broadcast"""
+    
+    def __init__(self, mesh: MeshNetwork, game_type: str, delay: float = BATCH_DELAY):
+        self.mesh = mesh
+        self.game_type = game_type
+        self.delay = delay
+        self._pending: List[dict] = []
+        self._timer: Optional[asyncio.Task] = None
+    
+    def add(self, move: dict):
+        """Queue a move for the next batch"""
+        self._pending.append(move)
+        if len(self._pending) >= BATCH_MAX_OPS:
+            asyncio.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after(self.delay))
+    
+    async def _flush_after(self, delay: float):
+        await asyncio.sleep(delay)
+        self._timer = None
+        await self.flush()
+    
+    async def flush(self):
+        """Broadcast everything queued so far"""
+        if not self._pending:
+            return
+        ops, self._pending = self._pending, []
+        await self.mesh.broadcast({
+            'game_type': self.game_type,
+            'app': 'game',
+            'type': 'game_batch',
+            'ops': ops
+        })
+
+
 class P2PGame:
     """Base class for P2P games"""
     
     def __init__(self, mesh: MeshNetwork):
         self.mesh = mesh
+        self._vip = mesh.virtual_ip  # fixed for the mesh's lifetime
         self.game_state: Optional[GameState] = None
         self.is_host = False
         
-        # Override mesh message handler
-        self._original_handler = mesh.on_message
-        mesh.on_message = self._handle_game_message
-    
-    def _handle_game_message(self, from_ip: str, data):
-        """Handle incoming game messages"""
-        print(f"[DEBUG GAME] Received from {from_ip}: {data}")  # Debug line
-        if isinstance(data, dict) and 'game_type' in data:
-            msg_type = data.get('msg_type')
-            
-            if msg_type == 'game_invite':
-                self._on_invite(from_ip, data)
-            elif msg_type == 'game_accept':
-                self._on_accept(from_ip, data)
-            elif msg_type == 'game_move':
-                self._on_move(from_ip, data)
-            elif msg_type == 'game_state':
-                self._on_state_update(from_ip, data)
-            elif msg_type == 'game_chat':
-                print(f"\n💬 [{from_ip}]: {data.get('message')}")
-        elif self._original_handler:
-            self._original_handler(from_ip, data)
+        # Host sends state as versioned deltas against what it last sent
+        self._state_version = 0
+        self._last_sent_state: dict = {}
+        
+        # Game messages are routed straight to this game by the mesh
+        for msg_type, handler in (
+            ('game_invite', self._on_invite),
+            ('game_accept', self._on_accept),
+            ('game_move', self._on_move),
+            ('game_batch', self._on_batch),
+            ('game_state', self._on_state_update),
+            ('game_state_delta', self._on_state_delta),
+            ('game_state_sync', self._on_state_sync),
+            ('game_chat', self._on_chat),
+        ):
+            mesh.register_handler('game', msg_type, handler)
+    
+    def _on_batch(self, from_ip: str, data: dict):
+        """Replay each move of a batch"""
+        for move in data.get('ops', ()):
+            self._on_move(from_ip, {'move': move})
+    
+    def _on_state_sync(self, from_ip: str, data: dict):
+        """A player missed a state delta - send them everything"""
+        if self.is_host:
+            asyncio.create_task(self._send_full_state(from_ip))
+    
+    def _on_chat(self, from_ip: str, data: dict):
+        print(f"\n💬 [{from_ip}]: {data.get('message')}")
     
     def _on_invite(self, from_ip: str, data: dict):
         """Handle game invitation"""
@@ -81,20 +131,85 @@ class P2PGame:
         """Handle state update from host - override in subclass for custom handling"""
         if not self.is_host:
             self.game_state = GameState(**data.get('state', {}))
+            self._state_version = data.get('version', 0)
             self._sync_from_state()
             self._render_game()
     
+    def _on_state_delta(self, from_ip: str, data: dict):
+        """Apply a state delta from host, or ask for the full state if one was missed"""
+        if self.is_host:
+            return
+        if data.get('base') != self._state_version:
+            asyncio.create_task(self.mesh.send(from_ip, {
+                'game_type': data.get('game_type'),
+                'app': 'game',
+                'type': 'game_state_sync'
+            }))
+            return
+        
+        patch = data.get('patch', {})
+        if self.game_state is None:
+            self.game_state = GameState(**patch)
+        else:
+            # Fields in 'patch' are replaced whole; 'merge' holds only the changed entries of dict fields
+            for key, value in patch.items():
+                setattr(self.game_state, key, value)
+        for key, value in data.get('merge', {}).items():
+            current = getattr(self.game_state, key)
+            if isinstance(current, dict):
+                current.update(value)
+            else:
+                setattr(self.game_state, key, value)
+        self._state_version = data['version']
+        self._sync_from_state()
+        self._render_game()
+    
     def _sync_from_state(self):
         """Sync local state from game_state - override in subclass"""
         pass
     
     async def _broadcast_state(self):
-        """Broadcast game state to all players"""
+        """Broadcast what changed in the game state since the last broadcast"""
+        if not self.game_state:
+            return
+        state = asdict(self.game_state)
+        last = self._last_sent_state
+        patch = {}
+        merge = {}
+        for key, value in state.items():
+            old = last.get(key)
+            if value == old:
+                continue
+            if isinstance(value, dict) and isinstance(old, dict) and old.keys() <= value.keys():
+                # One level deep: only the changed entries of dict fields. A dict that
+                # lost keys goes in patch instead, so peers drop them too.
+                merge[key] = {k: v for k, v in value.items() if k not in old or old[k] != v}
+            else:
+                patch[key] = value
+        if not patch and not merge:
+            return
+        
+        self._last_sent_state = state
+        self._state_version += 1
+        await self.mesh.broadcast({
+            'game_type': self.game_state.game_type,
+            'app': 'game',
+            'type': 'game_state_delta',
+            'base': self._state_version - 1,
+            'version': self._state_version,
+            'patch': patch,
+            'merge': merge
+        })
+    
+    async def _send_full_state(self, to_ip: str):
+        """Send the whole state to one player that fell out of sync"""
         if self.game_state:
-            await self.mesh.broadcast({
+            await self.mesh.send(to_ip, {
                 'game_type': self.game_state.game_type,
-                'msg_type': 'game_state',
-                'state': self.game_state.__dict__
+                'app': 'game',
+                'type': 'game_state',
+                'version': self._state_version,
+                'state': asdict(self.game_state)
             })
     
     async def invite(self, game_type: str):
@@ -102,15 +217,16 @@ class P2PGame:
         self.is_host = True
         self.game_state = GameState(
             game_type=game_type,
-            players=[self.mesh.virtual_ip],
-            current_turn=self.mesh.virtual_ip,
+            players=[self._vip],
+            current_turn=self._vip,
             data={}
         )
         
         await self.mesh.broadcast({
             'game_type': game_type,
-            'msg_type': 'game_invite',
-            'host': self.mesh.virtual_ip
+            'app': 'game',
+            'type': 'game_invite',
+            'host': self._vip
         })
         print(f"📤 Sent {game_type} invite to all peers")
     
@@ -122,8 +238,9 @@ class P2PGame:
             
             await self.mesh.send(from_ip, {
                 'game_type': data.get('game_type'),
-                'msg_type': 'game_accept',
-                'player': self.mesh.virtual_ip
+                'app': 'game',
+                'type': 'game_accept',
+                'player': self._vip
             })
             print(f"✅ Joined game!")
             del self.pending_invite
@@ -132,8 +249,9 @@ class P2PGame:
         """Make a game move"""
         await self.mesh.broadcast({
             'game_type': self.game_state.game_type,
-            'msg_type': 'game_move',
-            'player': self.mesh.virtual_ip,
+            'app': 'game',
+            'type': 'game_move',
+            'player': self._vip,
             'move': move_data
         })
     
@@ -141,7 +259,8 @@ class P2PGame:
         """Send chat message in game"""
         await self.mesh.broadcast({
             'game_type': 'chat',
-            'msg_type': 'game_chat',
+            'app': 'game',
+            'type': 'game_chat',
             'message': message
         })
     
@@ -150,6 +269,29 @@ class P2PGame:
         pass
 
 
+# Tic-Tac-Toe cells are a 9-bit mask per player, bit 3*row + col
+WIN_MASKS = (
+    0o007, 0o070, 0o700,  # rows
+    0o111, 0o222, 0o444,  # cols
+    0o421, 0o124,  # diagonals
+)
+FULL_MASK = 0o777
+
+
+@functools.lru_cache(maxsize=None)
+def _ttt_outcome(x_mask: int, o_mask: int) -> Optional[str]:
+    """'X' or 'O' for a win, 'draw' for a full board, else None.
+    Cached - a game only ever reaches a few thousand distinct positions."""
+    for w in WIN_MASKS:
+        if x_mask & w == w:
+            return 'X'
+        if o_mask & w == w:
+            return 'O'
+    if (x_mask | o_mask) == FULL_MASK:
+        return 'draw'
+    return None
+
+
 class TicTacToe(P2PGame):
     """P2P Tic-Tac-Toe Game"""
     
@@ -157,17 +299,18 @@ class TicTacToe(P2PGame):
     
     def __init__(self, mesh: MeshNetwork):
         super().__init__(mesh)
-        self.board = [[self.EMPTY] * 3 for _ in range(3)]
+        self.x_mask = 0
+        self.o_mask = 0
         self.symbols = {}  # player_ip -> X or O
         self.host_ip = None  # Track the host's IP
     
     async def start_game(self):
         """Start a new Tic-Tac-Toe game"""
         await self.invite('tictactoe')
-        self.board = [[self.EMPTY] * 3 for _ in range(3)]
-        self.game_state.data = {'board': self.board, 'host': self.mesh.virtual_ip}
-        self.symbols[self.mesh.virtual_ip] = 'X'
-        self.host_ip = self.mesh.virtual_ip
+        self.x_mask = self.o_mask = 0
+        self.game_state.data = {'x': 0, 'o': 0, 'host': self._vip}
+        self.symbols[self._vip] = 'X'
+        self.host_ip = self._vip
         print("⏳ Waiting for opponent...")
     
     def _on_accept(self, from_ip: str, data: dict):
@@ -179,26 +322,43 @@ class TicTacToe(P2PGame):
     def _sync_from_state(self):
         """Sync board and symbols from host's state"""
         if self.game_state and self.game_state.data:
-            board_data = self.game_state.data.get('board')
-            if board_data:
-                self.board = board_data
-            host = self.game_state.data.get('host')
+            data = self.game_state.data
+            if 'x' in data:
+                self.x_mask = data['x']
+                self.o_mask = data['o']
+            host = data.get('host')
             if host:
                 self.host_ip = host
                 self.symbols[host] = 'X'
-                self.symbols[self.mesh.virtual_ip] = 'O'
+                self.symbols[self._vip] = 'O'
+    
+    @staticmethod
+    def _bit(row: int, col: int) -> int:
+        if not (0 <= row < 3 and 0 <= col < 3):
+            raise IndexError(f"cell {row},{col} is off the board")
+        return 1 << (3 * row + col)
+    
+    def _place(self, bit: int, symbol: str):
+        if symbol == 'X':
+            self.x_mask |= bit
+        else:
+            self.o_mask |= bit
+    
+    def _store_board(self):
+        self.game_state.data['x'] = self.x_mask
+        self.game_state.data['o'] = self.o_mask
     
     def _on_move(self, from_ip: str, data: dict):
         move = data.get('move', {})
-        row, col = move.get('row'), move.get('col')
+        bit = self._bit(move.get('row'), move.get('col'))
         symbol = self.symbols.get(from_ip, 'O')
         
-        if self.board[row][col] == self.EMPTY:
-            self.board[row][col] = symbol
+        if not (self.x_mask | self.o_mask) & bit:
+            self._place(bit, symbol)
             
             if self.is_host:
-                self.game_state.data['board'] = self.board
-                self.game_state.current_turn = self.mesh.virtual_ip
+                self._store_board()
+                self.game_state.current_turn = self._vip
                 asyncio.create_task(self._broadcast_state())
             
             self._render_game()
@@ -213,9 +373,10 @@ class TicTacToe(P2PGame):
     
     async def play(self, row: int, col: int):
         """Make a move"""
-        if self.board[row][col] == self.EMPTY:
-            symbol = self.symbols.get(self.mesh.virtual_ip, 'X')
-            self.board[row][col] = symbol
+        bit = self._bit(row, col)
+        if not (self.x_mask | self.o_mask) & bit:
+            symbol = self.symbols.get(self._vip, 'X')
+            self._place(bit, symbol)
             
             await self.make_move({'row': row, 'col': col})
             
@@ -223,7 +384,7 @@ class TicTacToe(P2PGame):
                 peers = self.mesh.get_peers()
                 if peers:
                     self.game_state.current_turn = peers[0].virtual_ip
-                self.game_state.data['board'] = self.board
+                self._store_board()
                 await self._broadcast_state()
             
             self._render_game()
@@ -238,6 +399,15 @@ class TicTacToe(P2PGame):
         else:
             print("❌ Cell already taken!")
     
+    @property
+    def board(self) -> List[List[str]]:
+        """The board as rows of 'X', 'O' or EMPTY"""
+        x, o = self.x_mask, self.o_mask
+        return [
+            ['X' if x >> i & 1 else 'O' if o >> i & 1 else self.EMPTY for i in range(r, r + 3)]
+            for r in (0, 3, 6)
+        ]
+    
     def _render_game(self):
         print("\n┌───┬───┬───┐")
         for i, row in enumerate(self.board):
@@ -247,20 +417,11 @@ class TicTacToe(P2PGame):
         print("└───┴───┴───┘")
     
     def _check_winner(self) -> Optional[str]:
-        # Check rows, cols, diagonals
-        lines = []
-        lines.extend(self.board)  # rows
-        lines.extend([[self.board[i][j] for i in range(3)] for j in range(3)])  # cols
-        lines.append([self.board[i][i] for i in range(3)])  # diagonal
-        lines.append([self.board[i][2-i] for i in range(3)])  # anti-diagonal
-        
-        for line in lines:
-            if line[0] != self.EMPTY and line[0] == line[1] == line[2]:
-                return line[0]
-        return None
+        outcome = _ttt_outcome(self.x_mask, self.o_mask)
+        return outcome if outcome != 'draw' else None
     
     def _is_draw(self) -> bool:
-        return all(self.board[i][j] != self.EMPTY for i in range(3) for j in range(3))
+        return _ttt_outcome(self.x_mask, self.o_mask) == 'draw'
 
 
 class DrawingGame(P2PGame):
@@ -268,22 +429,48 @@ class DrawingGame(P2PGame):
     
     def __init__(self, mesh: MeshNetwork):
         super().__init__(mesh)
-        self.canvas: List[dict] = []  # List of drawing commands
+        # Canvas as parallel arrays, one entry per point; colors and players
+        # are stored as indexes into the interned lists below
+        self.xs = array.array('i')
+        self.ys = array.array('i')
+        self.colors = array.array('H')
+        self.player_ids = array.array('H')
+        self.color_names: List[str] = []
+        self.player_ips: List[str] = []
+        self._color_index: Dict[str, int] = {}
+        self._player_index: Dict[str, int] = {}
+        self._batcher = MoveBatcher(mesh, 'drawing')
+    
+    @staticmethod
+    def _intern(value: str, index: Dict[str, int], names: List[str]) -> int:
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(names)
+            names.append(value)
+        return i
+    
+    def _add_point(self, x: int, y: int, color: str, player: str):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.colors.append(self._intern(color, self._color_index, self.color_names))
+        self.player_ids.append(self._intern(player, self._player_index, self.player_ips))
+    
+    def points(self):
+        """Iterate the canvas as (x, y, color, player) tuples"""
+        colors, players = self.color_names, self.player_ips
+        for x, y, c, p in zip(self.xs, self.ys, self.colors, self.player_ids):
+            yield x, y, colors[c], players[p]
     
     async def draw(self, x: int, y: int, color: str = 'white'):
         """Add a point to the canvas"""
-        point = {'x': x, 'y': y, 'color': color, 'player': self.mesh.virtual_ip}
-        self.canvas.append(point)
-        await self.mesh.broadcast({
-            'game_type': 'drawing',
-            'msg_type': 'game_move',
-            'move': point
-        })
+        self._add_point(x, y, color, self._vip)
+        self._batcher.add({'x': x, 'y': y, 'color': color, 'player': self._vip})
     
     def _on_move(self, from_ip: str, data: dict):
         point = data.get('move', {})
-        self.canvas.append(point)
-        print(f"🎨 {from_ip} drew at ({point.get('x')}, {point.get('y')})")
+        x, y = point.get('x'), point.get('y')
+        self._add_point(x, y, point.get('color', 'white'), point.get('player', from_ip))
+        print(f"🎨 {from_ip} drew at ({x}, {y})")
 
 
 class QuizGame(P2PGame):
@@ -302,7 +489,7 @@ class QuizGame(P2PGame):
     async def start_quiz(self):
         """Start quiz game"""
         await self.invite('quiz')
-        self.scores[self.mesh.virtual_ip] = 0
+        self.scores[self._vip] = 0
         print("⏳ Waiting for players...")
     
     def _on_accept(self, from_ip: str, data: dict):
@@ -316,7 +503,8 @@ class QuizGame(P2PGame):
             print(f"\n❓ Question {self.current_question + 1}: {q['q']}")
             await self.mesh.broadcast({
                 'game_type': 'quiz',
-                'msg_type': 'game_move',
+                'app': 'game',
+                'type': 'game_move',
                 'move': {'question': q['q'], 'num': self.current_question}
             })
     
@@ -324,7 +512,7 @@ class QuizGame(P2PGame):
         """Submit answer"""
         q = self.questions[self.current_question]
         if ans.lower().strip() == q['a'].lower():
-            self.scores[self.mesh.virtual_ip] = self.scores.get(self.mesh.virtual_ip, 0) + 1
+            self.scores[self._vip] = self.scores.get(self._vip, 0) + 1
             print("✅ Correct!")
         else:
             print(f"❌ Wrong! Answer was: {q['a']}")
@@ -356,33 +544,35 @@ async def game_menu(mesh: MeshNetwork):
     quiz = None
     current_game = None
     
-    # Set up a listener for incoming invites when no game is active
-    def handle_invite(from_ip: str, data):
+    # Listen for incoming invites until a game takes over game messages
+    def handle_invite(from_ip: str, data: dict):
         nonlocal ttt, quiz, current_game
-        print(f"[DEBUG] Received message from {from_ip}: {data}")  # Debug line
-        if isinstance(data, dict) and data.get('msg_type') == 'game_invite':
-            game_type = data.get('game_type')
-            if game_type == 'tictactoe':
-                ttt = TicTacToe(mesh)
-                ttt._on_invite(from_ip, data)
-                current_game = ttt
-            elif game_type == 'quiz':
-                quiz = QuizGame(mesh)
-                quiz._on_invite(from_ip, data)
-                current_game = quiz
-            else:
-                print(f"\n🎮 Unknown game invite: {game_type}")
-        elif isinstance(data, dict) and data.get('type') == 'chat':
+        game_type = data.get('game_type')
+        if game_type == 'tictactoe':
+            ttt = TicTacToe(mesh)
+            ttt._on_invite(from_ip, data)
+            current_game = ttt
+        elif game_type == 'quiz':
+            quiz = QuizGame(mesh)
+            quiz._on_invite(from_ip, data)
+            current_game = quiz
+        else:
+            print(f"\n🎮 Unknown game invite: {game_type}")
+    
+    def handle_chat(from_ip: str, data):
+        if isinstance(data, dict) and data.get('type') == 'chat':
             print(f"\n💬 [{from_ip}]: {data.get('msg')}")
         elif isinstance(data, str):
             print(f"\n💬 [{from_ip}]: {data}")
     
-    mesh.on_message = handle_invite
+    mesh.register_handler('game', 'game_invite', handle_invite)
+    mesh.on_message = handle_chat
     
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
+    ui_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ui')
     while True:
         try:
-            cmd = await loop.run_in_executor(None, input, "\n> ")
+            cmd = await loop.run_in_executor(ui_pool, input, "\n> ")
             
             if cmd.startswith('/tictactoe'):
                 ttt = TicTacToe(mesh)
@@ -10,6 +10,8 @@ Requirements:
 2. Run as Administrator (required for creating network interfaces)
 3. pip install cryptography
 
+IP packets travel as binary MSG_RAW messages, sealed once by the mesh's AES-GCM layer.
+
 Usage:
     Host:   python p2p_vpn.py --host
     Friend: python p2p_vpn.py --connect <host-ip>:<port>
@@ -51,10 +53,35 @@ except ImportError:
     print("Error: mesh_network.py not found in same directory")
     sys.exit(1)
 
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
+# Park the TUN reader on WinTun's read event instead of polling
+kernel32 = ctypes.windll.kernel32
+kernel32.WaitForSingleObject.argtypes = [wintypes.HANDLE, wintypes.DWORD]
+kernel32.WaitForSingleObject.restype = wintypes.DWORD
+READ_WAIT_MS = 500  # Bounded so the thread still notices shutdown
+TUN_BATCH = 64      # Packets drained from the ring per hand-off to the event loop
+
+# MSG_RAW tag for tunneled IP packets (1 and 2 are used by p2p_fileshare)
+RAW_VPN_PACKET = 3
+
+# iphlpapi: assign adapter addresses directly instead of spawning netsh
+class MIB_UNICASTIPADDRESS_ROW(ctypes.Structure):
+    _fields_ = [
+        ('Address', ctypes.c_ubyte * 28),  # SOCKADDR_INET
+        ('InterfaceLuid', ctypes.c_uint64),
+        ('InterfaceIndex', ctypes.c_uint32),
+        ('PrefixOrigin', ctypes.c_int),
+        ('SuffixOrigin', ctypes.c_int),
+        ('ValidLifetime', ctypes.c_uint32),
+        ('PreferredLifetime', ctypes.c_uint32),
+        ('OnLinkPrefixLength', ctypes.c_uint8),
+        ('SkipAsSource', ctypes.c_uint8),
+        ('DadState', ctypes.c_int),
+        ('ScopeId', ctypes.c_uint32),
+        ('CreationTimeStamp', ctypes.c_int64),
+    ]
+
+IP_DAD_STATE_PREFERRED = 4
+ERROR_OBJECT_ALREADY_EXISTS = 5010
 
 # ============= WinTun Interface =============
 
@@ -126,6 +153,10 @@ class WinTun:
         # WintunGetReadWaitEvent
         self.wintun.WintunGetReadWaitEvent.argtypes = [ctypes.c_void_p]
         self.wintun.WintunGetReadWaitEvent.restype = wintypes.HANDLE
+        
+        # WintunGetAdapterLUID
+        self.wintun.WintunGetAdapterLUID.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint64)]
+        self.wintun.WintunGetAdapterLUID.restype = None
     
     def create_adapter(self, name="P2PVPN", tunnel_type="P2P"):
         """Create a new WinTun adapter"""
@@ -152,19 +183,22 @@ class WinTun:
         packet_ptr = self.wintun.WintunReceivePacket(self.session, ctypes.byref(packet_size))
         if not packet_ptr:
             return None
-        # Copy packet data
-        data = bytes(packet_ptr[:packet_size.value])
+        # Copy packet data (single memcpy; it outlives the ring slot)
+        data = ctypes.string_at(packet_ptr, packet_size.value)
         self.wintun.WintunReleaseReceivePacket(self.session, packet_ptr)
         return data
     
     def send_packet(self, data):
-        """Send a packet to the TUN interface"""
+        """Send a packet (any buffer) to the TUN interface"""
         if not self.session:
             return False
-        packet_ptr = self.wintun.WintunAllocateSendPacket(self.session, len(data))
+        size = len(data)
+        packet_ptr = self.wintun.WintunAllocateSendPacket(self.session, size)
         if not packet_ptr:
             return False
-        ctypes.memmove(packet_ptr, data, len(data))
+        # Copy straight from the caller's buffer into the ring slot
+        slot = (ctypes.c_ubyte * size).from_address(ctypes.addressof(packet_ptr.contents))
+        memoryview(slot).cast('B')[:] = data
         self.wintun.WintunSendPacket(self.session, packet_ptr)
         return True
     
@@ -174,6 +208,21 @@ class WinTun:
             return None
         return self.wintun.WintunGetReadWaitEvent(self.session)
     
+    def set_ipv4_address(self, ip, prefix_length):
+        """Assign a static IPv4 address via iphlpapi; False if Windows refused"""
+        luid = ctypes.c_uint64()
+        self.wintun.WintunGetAdapterLUID(self.adapter, ctypes.byref(luid))
+        
+        row = MIB_UNICASTIPADDRESS_ROW()
+        ctypes.windll.iphlpapi.InitializeUnicastIpAddressEntry(ctypes.byref(row))
+        struct.pack_into('<H', row.Address, 0, socket.AF_INET)
+        row.Address[4:8] = socket.inet_aton(ip)
+        row.InterfaceLuid = luid.value
+        row.OnLinkPrefixLength = prefix_length
+        row.DadState = IP_DAD_STATE_PREFERRED
+        err = ctypes.windll.iphlpapi.CreateUnicastIpAddressEntry(ctypes.byref(row))
+        return err in (0, ERROR_OBJECT_ALREADY_EXISTS)
+    
     def close(self):
         """Clean up adapter and session"""
         self.running = False
@@ -197,18 +246,9 @@ class P2PVPN:
         self.tun = None
         self.my_vpn_ip = None
         self.peer_vpn_ips = {}  # mesh_ip -> vpn_ip
+        self.vpn_to_mesh = {}   # packed 4-byte vpn_ip -> mesh_ip, for the TUN reader
         self.running = False
         self.loop = None
-        
-        # Generate encryption key from secret
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=b'p2pvpn_salt_v1',
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(secret.encode()))
-        self.fernet = Fernet(key)
     
     def _assign_vpn_ip(self, mesh_ip: str) -> str:
         """Assign a VPN IP based on mesh IP"""
@@ -256,13 +296,15 @@ class P2PVPN:
         self.tun.start_session()
         print("    Adapter created: 'Minecraft P2P'")
         
-        # Configure IP address using netsh
+        # Configure IP address (netsh only as a fallback - it spawns two processes)
         print("\n[3/4] Configuring network...")
-        os.system(f'netsh interface ip set address "Minecraft P2P" static {self.my_vpn_ip} 255.255.0.0')
+        if not self.tun.set_ipv4_address(self.my_vpn_ip, 16):
+            os.system(f'netsh interface ip set address "Minecraft P2P" static {self.my_vpn_ip} 255.255.0.0')
         print(f"    IP Address: {self.my_vpn_ip}/16")
         
-        # Register message handler
-        self.mesh.on_message = self._handle_mesh_message
+        # Register message handlers
+        self.mesh.register_handler('vpn', 'vpn_announce', self._on_vpn_announce)
+        self.mesh.register_raw_handler(RAW_VPN_PACKET, self._on_vpn_packet)
         
         # Start packet forwarding
         print("\n[4/4] Starting packet forwarding...")
@@ -302,72 +344,61 @@ class P2PVPN:
     async def _broadcast_presence(self):
         """Tell other peers our VPN IP"""
         msg = {
+            'app': 'vpn',
             'type': 'vpn_announce',
             'vpn_ip': self.my_vpn_ip,
             'mesh_ip': self.mesh.virtual_ip
         }
         await self.mesh.broadcast(msg)
     
-    def _handle_mesh_message(self, sender_ip: str, message):
-        """Handle messages from mesh network"""
-        # Handle dict or raw data
-        if isinstance(message, dict):
-            msg_type = message.get('type')
-            
-            if msg_type == 'vpn_announce':
-                # Peer announcing their VPN IP
-                vpn_ip = message.get('vpn_ip')
-                mesh_ip = message.get('mesh_ip')
-                if vpn_ip and mesh_ip and mesh_ip not in self.peer_vpn_ips:
-                    self.peer_vpn_ips[mesh_ip] = vpn_ip
-                    print(f"[VPN] Peer discovered: {vpn_ip} (mesh: {mesh_ip})")
-                    # Respond with our info (schedule in event loop)
-                    if self.loop:
-                        asyncio.run_coroutine_threadsafe(self._broadcast_presence(), self.loop)
-            
-            elif msg_type == 'vpn_packet':
-                # Encrypted IP packet from peer
-                try:
-                    encrypted = message.get('data')
-                    if encrypted:
-                        packet = self.fernet.decrypt(encrypted.encode())
-                        self.tun.send_packet(packet)
-                except Exception as e:
-                    pass  # Ignore decrypt errors
+    def _on_vpn_announce(self, sender_ip: str, message: dict):
+        """Peer announcing their VPN IP"""
+        vpn_ip = message.get('vpn_ip')
+        mesh_ip = message.get('mesh_ip')
+        if vpn_ip and mesh_ip and mesh_ip not in self.peer_vpn_ips:
+            self.peer_vpn_ips[mesh_ip] = vpn_ip
+            self.vpn_to_mesh[socket.inet_aton(vpn_ip)] = mesh_ip
+            print(f"[VPN] Peer discovered: {vpn_ip} (mesh: {mesh_ip})")
+            # Respond with our info (schedule in event loop)
+            if self.loop:
+                asyncio.run_coroutine_threadsafe(self._broadcast_presence(), self.loop)
+    
+    def _on_vpn_packet(self, sender_ip: str, packet: memoryview):
+        """IP packet from peer, already authenticated and decrypted by the mesh"""
+        self.tun.send_packet(packet)
     
     def _tun_to_mesh_thread(self):
         """Forward packets from TUN interface to mesh network (runs in thread)"""
+        # Bind hot-path callables once instead of per packet
+        event = self.tun.get_read_event()
+        receive, lookup = self.tun.receive_packet, self.vpn_to_mesh.get
+        wait = kernel32.WaitForSingleObject
         while self.running:
             try:
-                packet = self.tun.receive_packet()
-                if packet and len(packet) >= 20:
-                    # Parse destination IP from IPv4 header
-                    dst_ip = socket.inet_ntoa(packet[16:20])
-                    
-                    # Find peer by VPN IP
-                    target_mesh_ip = None
-                    for mesh_ip, vpn_ip in self.peer_vpn_ips.items():
-                        if vpn_ip == dst_ip:
-                            target_mesh_ip = mesh_ip
-                            break
-                    
-                    if target_mesh_ip and self.loop:
-                        # Encrypt and send via mesh
-                        encrypted = self.fernet.encrypt(packet).decode()
-                        
-                        async def send_packet():
-                            await self.mesh.send(target_mesh_ip, {
-                                'type': 'vpn_packet',
-                                'data': encrypted
-                            })
-                        
-                        asyncio.run_coroutine_threadsafe(send_packet(), self.loop)
-                else:
-                    time.sleep(0.001)
+                # Drain a burst from the ring, then wake the event loop once for all of it
+                batch = []
+                while len(batch) < TUN_BATCH and (packet := receive()) is not None:
+                    if len(packet) < 20 or packet[0] >> 4 != 4:
+                        continue  # Only IPv4 is routed; IPv6 would alias bytes 16-20 of its source
+                    # Find peer by the raw destination IP in the IPv4 header
+                    target_mesh_ip = lookup(packet[16:20])
+                    if target_mesh_ip:
+                        batch.append((target_mesh_ip, packet))
+                
+                if batch and self.loop:
+                    asyncio.run_coroutine_threadsafe(self._send_batch(batch), self.loop)
+                elif packet is None:
+                    # Ring drained: sleep until WinTun signals new packets
+                    wait(event, READ_WAIT_MS)
             except Exception as e:
                 if self.running:
                     time.sleep(0.01)
     
+    async def _send_batch(self, batch: list):
+        """Send a burst of (mesh_ip, packet) pairs; the mesh encrypts each once"""
+        for target_mesh_ip, packet in batch:
+            await self.mesh.send_raw(target_mesh_ip, RAW_VPN_PACKET, packet)
+    
     async def _peer_discovery_loop(self):
         """Periodically announce presence to find peers"""
         while self.running:
@@ -10,6 +10,7 @@ Usage:
     Friend: python p2p_vpn_fast.py --connect <host-ip>:<port>
 """
 
+import array
 import ctypes
 import sys
 import os
@@ -33,16 +34,69 @@ if not is_admin():
     print("=" * 60)
     sys.exit(1)
 
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Park threads on WinTun's read event instead of polling
+kernel32 = ctypes.windll.kernel32
+kernel32.WaitForSingleObject.argtypes = [wintypes.HANDLE, wintypes.DWORD]
+kernel32.WaitForSingleObject.restype = wintypes.DWORD
+READ_WAIT_MS = 500  # Bounded so the loop still notices shutdown
 
 # STUN for NAT traversal
 STUN_SERVER = "84.247.170.241"
 STUN_PORT = 3478
 MAGIC_COOKIE = 0x2112A442
 
+# Precompiled STUN wire formats
+_STUN_HDR = struct.Struct('!HHI')
+# Attribute type, length, then an XOR-MAPPED-ADDRESS value (reserved, family, port, IPv4)
+_STUN_ATTR = struct.Struct('!HHxxHI')
+
+NONCE_SIZE = 12  # AES-GCM nonce prepended to every datagram
+TAG_SIZE = 16    # AES-GCM authentication tag appended by the cipher
+SALT_SIZE = 16   # Random salt each side contributes to the session key in HELLO/WELCOME
+# Session nonces are direction || 64-bit counter, so host and client never collide
+NONCE_DIR_HOST = b'\x00\x00\x00\x01'
+NONCE_DIR_CLIENT = b'\x00\x00\x00\x02'
+RECV_BUF_SIZE = 65535
+SOCKET_BUF_SIZE = 4 * 1024 * 1024  # Kernel socket buffers, sized to absorb bursts like the WinTun ring
+TOS_EF = 0xB8  # DSCP Expedited Forwarding, for routers that honor it
+KEEPALIVE_INTERVAL = 20  # Seconds; well inside typical 30-60s NAT UDP timeouts
+STATS_INTERVAL = 5
+
+# Slots in FastVPN.stats; each is written by a single thread
+STAT_SENT = 0
+STAT_RECV = 1
+STAT_DROPPED = 2  # Datagrams from the peer's address that failed authentication
+
+# cryptography >= 44 can write plaintext into a caller-supplied buffer
+_HAS_DECRYPT_INTO = hasattr(AESGCM, 'decrypt_into')
+
+
+# iphlpapi: assign adapter addresses directly instead of spawning netsh
+class MIB_UNICASTIPADDRESS_ROW(ctypes.Structure):
+    _fields_ = [
+        ('Address', ctypes.c_ubyte * 28),  # SOCKADDR_INET
+        ('InterfaceLuid', ctypes.c_uint64),
+        ('InterfaceIndex', ctypes.c_uint32),
+        ('PrefixOrigin', ctypes.c_int),
+        ('SuffixOrigin', ctypes.c_int),
+        ('ValidLifetime', ctypes.c_uint32),
+        ('PreferredLifetime', ctypes.c_uint32),
+        ('OnLinkPrefixLength', ctypes.c_uint8),
+        ('SkipAsSource', ctypes.c_uint8),
+        ('DadState', ctypes.c_int),
+        ('ScopeId', ctypes.c_uint32),
+        ('CreationTimeStamp', ctypes.c_int64),
+    ]
+
+IP_DAD_STATE_PREFERRED = 4
+ERROR_OBJECT_ALREADY_EXISTS = 5010
+
 
 class WinTun:
     """Minimal WinTun wrapper"""
@@ -71,6 +125,10 @@ class WinTun:
         self.wintun.WintunAllocateSendPacket.argtypes = [ctypes.c_void_p, wintypes.DWORD]
         self.wintun.WintunAllocateSendPacket.restype = ctypes.POINTER(ctypes.c_ubyte)
         self.wintun.WintunSendPacket.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.wintun.WintunGetReadWaitEvent.argtypes = [ctypes.c_void_p]
+        self.wintun.WintunGetReadWaitEvent.restype = wintypes.HANDLE
+        self.wintun.WintunGetAdapterLUID.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint64)]
+        self.wintun.WintunGetAdapterLUID.restype = None
     
     def create(self, name="P2P VPN"):
         self.adapter = self.wintun.WintunCreateAdapter(name, "P2P", None)
@@ -80,21 +138,67 @@ class WinTun:
         if not self.session:
             raise Exception("Failed to start session")
     
+    def read_event(self):
+        """Event handle signaled when packets are waiting"""
+        return self.wintun.WintunGetReadWaitEvent(self.session)
+    
     def recv(self):
         size = wintypes.DWORD()
         ptr = self.wintun.WintunReceivePacket(self.session, ctypes.byref(size))
         if not ptr:
             return None
-        data = bytes(ptr[:size.value])
+        data = ctypes.string_at(ptr, size.value)  # Single memcpy
         self.wintun.WintunReleaseReceivePacket(self.session, ptr)
         return data
     
+    def recv_view(self):
+        """Zero-copy receive: (ptr, view of the packet in the ring) or (None, None).
+        The view is only valid until release(ptr)."""
+        size = wintypes.DWORD()
+        ptr = self.wintun.WintunReceivePacket(self.session, ctypes.byref(size))
+        if not ptr:
+            return None, None
+        ring = (ctypes.c_ubyte * size.value).from_address(ctypes.addressof(ptr.contents))
+        return ptr, memoryview(ring).cast('B')
+    
+    def release(self, ptr):
+        """Hand a packet from recv_view() back to the ring"""
+        self.wintun.WintunReleaseReceivePacket(self.session, ptr)
+    
     def send(self, data):
         ptr = self.wintun.WintunAllocateSendPacket(self.session, len(data))
         if ptr:
             ctypes.memmove(ptr, data, len(data))
             self.wintun.WintunSendPacket(self.session, ptr)
     
+    def send_into(self, size):
+        """Zero-copy send: (ptr, writable view of a ring slot) or (None, None).
+        Fill the view, then commit(ptr)."""
+        ptr = self.wintun.WintunAllocateSendPacket(self.session, size)
+        if not ptr:
+            return None, None
+        ring = (ctypes.c_ubyte * size).from_address(ctypes.addressof(ptr.contents))
+        return ptr, memoryview(ring).cast('B')
+    
+    def commit(self, ptr):
+        """Send a slot filled via send_into()"""
+        self.wintun.WintunSendPacket(self.session, ptr)
+    
+    def set_ipv4_address(self, ip, prefix_length):
+        """Assign a static IPv4 address via iphlpapi; False if Windows refused"""
+        luid = ctypes.c_uint64()
+        self.wintun.WintunGetAdapterLUID(self.adapter, ctypes.byref(luid))
+        
+        row = MIB_UNICASTIPADDRESS_ROW()
+        ctypes.windll.iphlpapi.InitializeUnicastIpAddressEntry(ctypes.byref(row))
+        struct.pack_into('<H', row.Address, 0, socket.AF_INET)
+        row.Address[4:8] = socket.inet_aton(ip)
+        row.InterfaceLuid = luid.value
+        row.OnLinkPrefixLength = prefix_length
+        row.DadState = IP_DAD_STATE_PREFERRED
+        err = ctypes.windll.iphlpapi.CreateUnicastIpAddressEntry(ctypes.byref(row))
+        return err in (0, ERROR_OBJECT_ALREADY_EXISTS)
+    
     def close(self):
         if self.session:
             self.wintun.WintunEndSession(self.session)
@@ -105,27 +209,29 @@ class WinTun:
 def stun_get_external(sock):
     """Get external IP:port via STUN"""
     txn_id = os.urandom(12)
-    msg = struct.pack('!HHI', 0x0001, 0, MAGIC_COOKIE) + txn_id
+    msg = _STUN_HDR.pack(0x0001, 0, MAGIC_COOKIE) + txn_id
     
     try:
         sock.sendto(msg, (STUN_SERVER, STUN_PORT))
         sock.settimeout(3)
         data, _ = sock.recvfrom(1024)
-        sock.settimeout(0.001)  # Fast non-blocking for game packets
+        sock.settimeout(None)  # Blocking; the recv thread sleeps in the kernel
         
-        offset = 20
-        msg_len = struct.unpack('!H', data[2:4])[0]
+        msg_type, msg_len, cookie = _STUN_HDR.unpack_from(data)
+        if msg_type != 0x0101 or cookie != MAGIC_COOKIE:  # Not a Binding Success
+            return None, None
         
-        while offset < 20 + msg_len:
-            attr_type, attr_len = struct.unpack('!HH', data[offset:offset+4])
-            attr_val = data[offset+4:offset+4+attr_len]
+        # One unpack per attribute; anything shorter than 12 bytes can't be the address
+        offset = 20
+        end = min(20 + msg_len, len(data))
+        while offset + _STUN_ATTR.size <= end:
+            attr_type, attr_len, port, ip = _STUN_ATTR.unpack_from(data, offset)
             
             if attr_type == 0x0020:  # XOR-MAPPED-ADDRESS
-                port = struct.unpack('!H', attr_val[2:4])[0] ^ (MAGIC_COOKIE >> 16)
-                ip = struct.unpack('!I', attr_val[4:8])[0] ^ MAGIC_COOKIE
-                return socket.inet_ntoa(struct.pack('!I', ip)), port
+                ip ^= MAGIC_COOKIE
+                return socket.inet_ntoa(ip.to_bytes(4, 'big')), port ^ (MAGIC_COOKIE >> 16)
             
-            offset += 4 + attr_len + (4 - attr_len % 4) % 4
+            offset += 4 + ((attr_len + 3) & ~3)
     except:
         pass
     return None, None
@@ -142,32 +248,106 @@ class FastVPN:
             salt=b'fastvpn',
             iterations=50000,  # Reduced iterations for speed
         )
-        key = base64.urlsafe_b64encode(kdf.derive(secret.encode()))
-        self.cipher = Fernet(key)
+        # The password key only seals the handshake (with random nonces); traffic uses a
+        # per-session key from both sides' salts, so counter nonces never repeat under one key
+        self._base_key = kdf.derive(secret.encode())
+        self._handshake = AESGCM(self._base_key)
+        # AES-GCM runs on AES-NI inside OpenSSL; no base64 or HMAC pass like Fernet
+        self.cipher = None  # Session cipher, set by _start_session()
+        self._nonce_prefix = b''
+        self._ctr = 0
         
         self.sock = None
         self.tun = None
         self.peer_addr = None
         self.my_vpn_ip = None
         self.peer_vpn_ip = None
+        self.ext_ip = None  # Our STUN-mapped address, looked up once
+        self.ext_port = None
         self.running = False
         
-        # Packet stats
-        self.packets_sent = 0
-        self.packets_recv = 0
+        # Packet stats, kept in fixed int64 slots rather than attributes
+        self.stats = array.array('Q', [0, 0, 0])
+        self._rx_plain = memoryview(bytearray(RECV_BUF_SIZE))  # Decrypt scratch for the UDP -> TUN thread
+    
+    def _seal_handshake(self, data):
+        """Encrypt a handshake message under the password key with a random nonce"""
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._handshake.encrypt(nonce, data, None)
+    
+    def _open_handshake(self, data):
+        """Decrypt a handshake message (raises InvalidTag if forged)"""
+        return self._handshake.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None)
+    
+    def _start_session(self, client_salt, host_salt, is_host):
+        """Derive this session's traffic key from the salts exchanged in HELLO/WELCOME"""
+        key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=client_salt + host_salt,
+            info=b'fastvpn session',
+        ).derive(self._base_key)
+        self.cipher = AESGCM(key)
+        # Nonce = direction || 64-bit counter: no getrandom() per packet
+        self._nonce_prefix = NONCE_DIR_HOST if is_host else NONCE_DIR_CLIENT
+        self._ctr = 0
+    
+    def encrypt(self, data):
+        """Encrypt a packet as nonce + ciphertext"""
+        nonce = self._nonce_prefix + self._ctr.to_bytes(8, 'big')
+        self._ctr += 1
+        return nonce + self.cipher.encrypt(nonce, data, None)
+    
+    def decrypt(self, data):
+        """Decrypt a nonce + ciphertext packet (raises InvalidTag if forged)"""
+        return self.cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None)
+    
+    def _to_tun(self, data):
+        """Decrypt a datagram and hand it to WinTun; forged ones never reach the adapter"""
+        size = len(data) - NONCE_SIZE - TAG_SIZE
+        if size < 20:  # Not a valid IP packet
+            return
+        try:
+            if _HAS_DECRYPT_INTO:
+                # Into scratch first: a WinTun slot can't be cancelled once allocated
+                plain = self._rx_plain[:size]
+                self.cipher.decrypt_into(data[:NONCE_SIZE], data[NONCE_SIZE:], None, plain)
+            else:
+                plain = self.decrypt(data)
+        except InvalidTag:
+            self.stats[STAT_DROPPED] += 1
+            return
+        
+        ptr, view = self.tun.send_into(size)
+        if not ptr:
+            return  # Ring full
+        view[:] = plain
+        self.tun.commit(ptr)
+        self.stats[STAT_RECV] += 1
+    
+    def _open_socket(self):
+        """Bind a UDP socket tuned for bursty game traffic"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUF_SIZE)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, TOS_EF)
+        except OSError:
+            pass  # Marking is best effort
+        return sock
     
     def start_host(self):
         """Start as host"""
         print("\n[FastVPN] Starting as HOST...")
         
         # Create UDP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(('0.0.0.0', 0))
+        self.sock = self._open_socket()
         
         # Get external address
-        ext_ip, ext_port = stun_get_external(self.sock)
-        if not ext_ip:
+        self.ext_ip, self.ext_port = stun_get_external(self.sock)
+        if not self.ext_ip:
             print("[ERROR] STUN failed!")
             return
         
@@ -179,14 +359,15 @@ class FastVPN:
         self.my_vpn_ip = "10.147.1.1"
         self.peer_vpn_ip = "10.147.1.2"
         
-        os.system(f'netsh interface ip set address "Minecraft LAN" static {self.my_vpn_ip} 255.255.255.0')
+        if not self.tun.set_ipv4_address(self.my_vpn_ip, 24):
+            os.system(f'netsh interface ip set address "Minecraft LAN" static {self.my_vpn_ip} 255.255.255.0')
         
         print(f"\n{'='*50}")
         print(f"  VPN Ready!")
         print(f"  Your VPN IP: {self.my_vpn_ip}")
         print(f"{'='*50}")
         print(f"\n  Friend runs:")
-        print(f"  python p2p_vpn_fast.py --connect {ext_ip}:{ext_port}")
+        print(f"  python p2p_vpn_fast.py --connect {self.ext_ip}:{self.ext_port}")
         print(f"\n  Then in Minecraft, Open to LAN")
         print(f"  Friend connects to: {self.my_vpn_ip}:<LAN port>")
         print(f"{'='*50}\n")
@@ -200,13 +381,18 @@ class FastVPN:
             while not self.peer_addr:
                 try:
                     data, addr = self.sock.recvfrom(2048)
-                    decrypted = self.cipher.decrypt(data)
-                    if decrypted == b'HELLO':
+                    decrypted = self._open_handshake(data)
+                    if decrypted.startswith(b'HELLO') and len(decrypted) == 5 + SALT_SIZE:
                         self.peer_addr = addr
-                        # Send response with peer's VPN IP
-                        self.sock.sendto(self.cipher.encrypt(b'WELCOME:' + self.peer_vpn_ip.encode()), addr)
+                        # Send response with our salt and the peer's VPN IP
+                        host_salt = os.urandom(SALT_SIZE)
+                        welcome = b'WELCOME:' + host_salt + self.peer_vpn_ip.encode()
+                        self.sock.sendto(self._seal_handshake(welcome), addr)
+                        self._start_session(decrypted[5:], host_salt, is_host=True)
                         print(f"[+] Friend connected from {addr[0]}:{addr[1]}")
                         print(f"[+] Friend's VPN IP: {self.peer_vpn_ip}")
+                except InvalidTag:
+                    continue  # Stray or forged datagram
                 except socket.timeout:
                     print("[!] Timeout waiting for friend")
                     return
@@ -214,7 +400,7 @@ class FastVPN:
             print(f"[!] Error: {e}")
             return
         
-        self.sock.settimeout(0.001)
+        self.sock.settimeout(None)
         self._run_loops()
     
     def start_client(self, host_addr):
@@ -225,12 +411,10 @@ class FastVPN:
         host_port = int(host_port)
         
         # Create UDP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(('0.0.0.0', 0))
+        self.sock = self._open_socket()
         
         # Do STUN to punch hole
-        stun_get_external(self.sock)
+        self.ext_ip, self.ext_port = stun_get_external(self.sock)
         
         # Setup TUN
         self.tun = WinTun()
@@ -242,23 +426,28 @@ class FastVPN:
         print("[*] Punching NAT hole...")
         self.sock.settimeout(5)
         
+        client_salt = os.urandom(SALT_SIZE)
+        hello = self._seal_handshake(b'HELLO' + client_salt)
         for i in range(10):
-            self.sock.sendto(self.cipher.encrypt(b'HELLO'), self.peer_addr)
+            self.sock.sendto(hello, self.peer_addr)
             try:
                 data, addr = self.sock.recvfrom(2048)
-                decrypted = self.cipher.decrypt(data)
-                if decrypted.startswith(b'WELCOME:'):
-                    self.my_vpn_ip = decrypted.split(b':')[1].decode()
+                decrypted = self._open_handshake(data)
+                if decrypted.startswith(b'WELCOME:') and len(decrypted) > 8 + SALT_SIZE:
+                    host_salt = decrypted[8:8 + SALT_SIZE]
+                    self.my_vpn_ip = decrypted[8 + SALT_SIZE:].decode()
                     self.peer_vpn_ip = "10.147.1.1"
+                    self._start_session(client_salt, host_salt, is_host=False)
                     print(f"[+] Connected!")
                     break
-            except socket.timeout:
+            except (socket.timeout, InvalidTag):
                 continue
         else:
             print("[!] Failed to connect - NAT may be too strict")
             return
         
-        os.system(f'netsh interface ip set address "Minecraft LAN" static {self.my_vpn_ip} 255.255.255.0')
+        if not self.tun.set_ipv4_address(self.my_vpn_ip, 24):
+            os.system(f'netsh interface ip set address "Minecraft LAN" static {self.my_vpn_ip} 255.255.255.0')
         
         print(f"\n{'='*50}")
         print(f"  Connected!")
@@ -270,61 +459,79 @@ class FastVPN:
         print(f"{'='*50}\n")
         
         self.running = True
-        self.sock.settimeout(0.001)
+        self.sock.settimeout(None)
         self._run_loops()
     
     def _run_loops(self):
-        """Run send/receive loops"""
+        """Run send/receive loops (only entered once the handshake set peer_addr)"""
         
         # TUN -> UDP (send to peer)
         def tun_to_udp():
+            # Bind hot-path callables once instead of per packet
+            event = self.tun.read_event()
+            recv_view, release = self.tun.recv_view, self.tun.release
+            encrypt, sendto, addr = self.encrypt, self.sock.sendto, self.peer_addr
+            wait, stats = kernel32.WaitForSingleObject, self.stats
             while self.running:
+                ptr, pkt = recv_view()
+                if not ptr:
+                    # Ring drained: sleep until WinTun signals new packets
+                    wait(event, READ_WAIT_MS)
+                    continue
                 try:
-                    pkt = self.tun.recv()
-                    if pkt and self.peer_addr:
-                        encrypted = self.cipher.encrypt(pkt)
-                        self.sock.sendto(encrypted, self.peer_addr)
-                        self.packets_sent += 1
-                except:
-                    pass
-        
-        # UDP -> TUN (receive from peer)
+                    # Encrypt straight out of the WinTun ring
+                    sendto(encrypt(pkt), addr)
+                    stats[STAT_SENT] += 1
+                except OSError:
+                    pass  # Transient send failure (buffer full, route flap); drop the packet
+                finally:
+                    release(ptr)
+        
+        # UDP -> TUN (receive from peer); blocks until a datagram arrives
         def udp_to_tun():
+            # One receive buffer for the whole session, decrypted from in place
+            rxbuf = bytearray(RECV_BUF_SIZE)
+            rxview = memoryview(rxbuf)
+            recvfrom_into, to_tun, peer_addr = self.sock.recvfrom_into, self._to_tun, self.peer_addr
             while self.running:
                 try:
-                    data, addr = self.sock.recvfrom(65535)
-                    if addr == self.peer_addr:
-                        pkt = self.cipher.decrypt(data)
-                        if len(pkt) >= 20:  # Valid IP packet
-                            self.tun.send(pkt)
-                            self.packets_recv += 1
-                except socket.timeout:
-                    pass
-                except:
-                    pass
+                    nbytes, addr = recvfrom_into(rxbuf)
+                    if addr == peer_addr:
+                        to_tun(rxview[:nbytes])
+                except OSError:
+                    pass  # ICMP-induced resets, socket closed on shutdown
         
-        # Stats display
-        def show_stats():
-            while self.running:
-                time.sleep(5)
-                print(f"[Stats] Sent: {self.packets_sent} | Recv: {self.packets_recv}")
+        # Keep the NAT mapping alive while the game is idle. The datagram is
+        # sealed before the TUN thread starts (encrypt() isn't thread-safe) and
+        # resent as-is; the peer drops anything too short to be an IP packet.
+        keepalive_pkt = self.encrypt(b'\x00')
         
         t1 = threading.Thread(target=tun_to_udp, daemon=True)
         t2 = threading.Thread(target=udp_to_tun, daemon=True)
-        t3 = threading.Thread(target=show_stats, daemon=True)
         
         t1.start()
         t2.start()
-        t3.start()
         
         print("[*] VPN running. Press Ctrl+C to stop.\n")
         
+        # Stats and keepalives ride the main thread's 1s tick
+        last_sent = -1
+        ticks = 0
         try:
             while self.running:
                 time.sleep(1)
+                ticks += 1
+                sent, recv, dropped = self.stats
+                if ticks % STATS_INTERVAL == 0:
+                    print(f"[Stats] Sent: {sent} | Recv: {recv} | Dropped: {dropped}")
+                if ticks % KEEPALIVE_INTERVAL == 0:
+                    if sent == last_sent:
+                        self.sock.sendto(keepalive_pkt, self.peer_addr)
+                    last_sent = sent
         except KeyboardInterrupt:
             print("\n[*] Shutting down...")
             self.running = False
+            self.sock.close()  # Wakes the blocked recvfrom
             self.tun.close()
 
 
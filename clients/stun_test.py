@@ -9,6 +9,7 @@ import socket
 import struct
 import os
 import sys
+from typing import Dict
 
 # STUN Message Types
 BINDING_REQUEST = 0x0001
@@ -21,23 +22,31 @@ SOFTWARE = 0x8022
 
 MAGIC_COOKIE = 0x2112A442
 
+# Precompiled wire formats
+_HDR = struct.Struct('!HHI')
+_ATTR = struct.Struct('!HH')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+
+# RFC 5389-style retransmission: resend after 0.5s, 1s, 2s, then wait out the timeout
+RETRANSMIT_DELAYS = (0.5, 1.0, 2.0)
+
+# Binding Request header (type, zero length, magic cookie); only the transaction ID varies
+_BINDING_PREFIX = _HDR.pack(BINDING_REQUEST, 0, MAGIC_COOKIE)
+
 def create_stun_request():
     """Create a STUN Binding Request"""
-    msg_type = BINDING_REQUEST
-    msg_length = 0
-    magic_cookie = MAGIC_COOKIE
     transaction_id = os.urandom(12)
-    
-    header = struct.pack('!HHI', msg_type, msg_length, magic_cookie) + transaction_id
-    return header, transaction_id
+    return _BINDING_PREFIX + transaction_id, transaction_id
 
 def parse_stun_response(data, transaction_id):
     """Parse STUN Binding Response"""
     if len(data) < 20:
         return None, "Response too short"
     
-    msg_type, msg_length, magic = struct.unpack('!HHI', data[:8])
-    resp_transaction_id = data[8:20]
+    mv = memoryview(data)  # Attribute slices below are views, not copies
+    msg_type, msg_length, magic = _HDR.unpack_from(mv, 0)
+    resp_transaction_id = mv[8:20]
     
     if resp_transaction_id != transaction_id:
         return None, "Transaction ID mismatch"
@@ -45,90 +54,143 @@ def parse_stun_response(data, transaction_id):
     if msg_type != BINDING_RESPONSE:
         return None, f"Unexpected message type: {msg_type}"
     
-    # Parse attributes
+    if magic != MAGIC_COOKIE:
+        return None, "Bad magic cookie"
+    
+    end = 20 + msg_length
+    if end > len(data):
+        return None, "Truncated response"
+    
+    # Parse attributes (bounds checked once here, so the branches below can't overrun)
     result = {}
     offset = 20
-    while offset < 20 + msg_length:
-        if offset + 4 > len(data):
+    while offset + 4 <= end:
+        attr_type, attr_length = _ATTR.unpack_from(mv, offset)
+        if offset + 4 + attr_length > end:
             break
-        attr_type, attr_length = struct.unpack('!HH', data[offset:offset+4])
-        attr_value = data[offset+4:offset+4+attr_length]
+        attr_value = mv[offset+4:offset+4+attr_length]
         
-        if attr_type == XOR_MAPPED_ADDRESS:
+        if attr_type in (XOR_MAPPED_ADDRESS, MAPPED_ADDRESS) and attr_length < 8:
+            pass  # Too short for an IPv4 address
+        elif attr_type == XOR_MAPPED_ADDRESS:
             family = attr_value[1]
-            xor_port = struct.unpack('!H', attr_value[2:4])[0] ^ (MAGIC_COOKIE >> 16)
+            xor_port = _U16.unpack_from(attr_value, 2)[0] ^ (MAGIC_COOKIE >> 16)
             if family == 0x01:  # IPv4
-                xor_ip_bytes = struct.unpack('!I', attr_value[4:8])[0] ^ MAGIC_COOKIE
-                xor_ip = socket.inet_ntoa(struct.pack('!I', xor_ip_bytes))
-                result['external_ip'] = xor_ip
+                ip_int = _U32.unpack_from(attr_value, 4)[0] ^ MAGIC_COOKIE
+                result['external_ip'] = socket.inet_ntoa(ip_int.to_bytes(4, 'big'))
                 result['external_port'] = xor_port
         
         elif attr_type == MAPPED_ADDRESS:
             family = attr_value[1]
-            port = struct.unpack('!H', attr_value[2:4])[0]
+            port = _U16.unpack_from(attr_value, 2)[0]
             if family == 0x01:  # IPv4
                 ip = socket.inet_ntoa(attr_value[4:8])
                 result['mapped_ip'] = ip
                 result['mapped_port'] = port
         
         elif attr_type == SOFTWARE:
-            result['server_software'] = attr_value.decode('utf-8', errors='ignore').strip('\x00')
+            result['server_software'] = str(attr_value, 'utf-8', errors='ignore').strip('\x00')
         
         # Move to next attribute (4-byte aligned)
-        offset += 4 + attr_length + (4 - attr_length % 4) % 4
+        offset += 4 + ((attr_length + 3) & ~3)
     
     return result, None
 
-async def test_stun_server(server, port=3478, timeout=5):
-    """Test STUN server and return external IP"""
-    print(f"\n🔍 Testing STUN server: {server}:{port}")
-    print("-" * 50)
+class StunProtocol(asyncio.DatagramProtocol):
+    """Shared endpoint: routes each reply to the query waiting on its transaction ID"""
+    
+    def __init__(self):
+        self.pending: Dict[bytes, asyncio.Future] = {}  # transaction_id -> (data, addr)
+    
+    def datagram_received(self, data, addr):
+        fut = self.pending.get(data[8:20])
+        if fut is not None and not fut.done():
+            fut.set_result((data, addr))
     
+    def error_received(self, exc):
+        # Unconnected socket: an ICMP error can't be tied to one server, so let that query time out
+        pass
+
+async def open_stun_endpoint():
+    """Open one unconnected UDP endpoint that any number of queries can share"""
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(
+        StunProtocol,
+        local_addr=('0.0.0.0', 0),
+        family=socket.AF_INET
+    )
+
+async def query_stun_server(server, port=3478, timeout=5, endpoint=None):
+    """Send a Binding Request and wait for the reply, without printing.
+    Uses the shared (transport, protocol) endpoint if given, else opens its own.
+    Returns (result, error, responder address)."""
+    loop = asyncio.get_running_loop()
+    own_transport = None
+    transaction_id = None
     try:
-        # Create UDP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
-        sock.setblocking(False)
+        if endpoint is None:
+            endpoint = own_transport, _ = await open_stun_endpoint()
+        transport, protocol = endpoint
+        
+        # Resolve up front so sendto never blocks the loop on DNS
+        infos = await loop.getaddrinfo(server, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        server_addr = infos[0][4]
         
-        # Create and send STUN request
         request, transaction_id = create_stun_request()
+        reply = loop.create_future()
+        protocol.pending[transaction_id] = reply
         
-        loop = asyncio.get_event_loop()
-        await loop.sock_sendto(sock, request, (server, port))
-        print(f"✅ Sent STUN Binding Request")
+        # Resend the same transaction until a reply arrives, within the overall timeout
+        deadline = loop.time() + timeout
+        for delay in RETRANSMIT_DELAYS + (timeout,):
+            transport.sendto(request, server_addr)
+            wait = min(delay, deadline - loop.time())
+            if wait <= 0:
+                break
+            done, _ = await asyncio.wait([reply], timeout=wait)
+            if done:
+                break
         
-        # Wait for response
-        try:
-            data, addr = await asyncio.wait_for(
-                loop.sock_recvfrom(sock, 1024),
-                timeout=timeout
-            )
-            print(f"✅ Received response from {addr[0]}:{addr[1]}")
-            
-            # Parse response
-            result, error = parse_stun_response(data, transaction_id)
-            if error:
-                print(f"❌ Error: {error}")
-                return None
-            
-            print(f"\n📋 Results:")
-            if 'external_ip' in result:
-                print(f"   External IP:   {result['external_ip']}")
-                print(f"   External Port: {result['external_port']}")
-            if 'server_software' in result:
-                print(f"   Server:        {result['server_software']}")
-            
-            return result
-            
-        except asyncio.TimeoutError:
-            print(f"❌ Timeout - No response from server")
-            return None
-            
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        return None
+        if not reply.done():
+            return None, "Timeout - No response from server", None
+        data, addr = reply.result()
+        
+        result, error = parse_stun_response(data, transaction_id)
+        return result, error, addr
+    except OSError as e:
+        return None, str(e), None
     finally:
-        sock.close()
+        if transaction_id is not None:
+            endpoint[1].pending.pop(transaction_id, None)
+        if own_transport:
+            own_transport.close()
+
+def print_stun_header(server, port):
+    print(f"\n🔍 Testing STUN server: {server}:{port}")
+    print("-" * 50)
+
+def report_stun_result(result, error, addr):
+    """Print the outcome of one query; returns result, or None on failure"""
+    if addr:
+        print(f"✅ Received response from {addr[0]}:{addr[1]}")
+    if error:
+        print(f"❌ Error: {error}")
+        return None
+    
+    print(f"\n📋 Results:")
+    if 'external_ip' in result:
+        print(f"   External IP:   {result['external_ip']}")
+        print(f"   External Port: {result['external_port']}")
+    if 'server_software' in result:
+        print(f"   Server:        {result['server_software']}")
+    
+    return result
+
+async def test_stun_server(server, port=3478, timeout=5):
+    """Test STUN server and return external IP"""
+    print_stun_header(server, port)
+    result, error, addr = await query_stun_server(server, port, timeout)
+    return report_stun_result(result, error, addr)
 
 async def compare_stun_servers():
     """Compare multiple STUN servers"""
@@ -138,11 +200,21 @@ async def compare_stun_servers():
         ("stun1.l.google.com", 19302, "Google 1"),
     ]
     
+    # Probe all servers at once over one socket: a dead server costs one timeout, not one per server
+    print(f"🔍 Querying {len(servers)} STUN servers...")
+    endpoint = await open_stun_endpoint()
+    try:
+        replies = await asyncio.gather(*(query_stun_server(server, port, endpoint=endpoint)
+                                         for server, port, _ in servers))
+    finally:
+        endpoint[0].close()
+    
     results = []
-    for server, port, name in servers:
+    for (server, port, name), reply in zip(servers, replies):
         print(f"\n{'='*50}")
         print(f"📡 {name}")
-        result = await test_stun_server(server, port)
+        print_stun_header(server, port)
+        result = report_stun_result(*reply)
         if result:
             results.append((name, result))
     
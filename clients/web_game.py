@@ -8,14 +8,63 @@ import asyncio
 import json
 import os
 from aiohttp import web
-from mesh_network import MeshNetwork
-from typing import Optional, Set
-from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from dataclasses import dataclass
 
+if TYPE_CHECKING:
+    # Imported on first connect: the mesh (and its crypto stack) isn't needed to serve the page
+    from mesh_network import MeshNetwork
 
-@dataclass
+# Optional: orjson encodes/parses websocket payloads several times faster.
+# Payloads are UTF-8 JSON bytes sent as binary frames, so a broadcast is encoded
+# once rather than once per client; the page decodes them with a TextDecoder.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+# Optional: uvloop runs the server's event loop (websockets and mesh UDP) faster
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Messages a web client may fall behind by before it is disconnected
+WEB_QUEUE_SIZE = 100
+
+# Bytes a websocket may buffer before send_bytes() waits for a drain, so bursts of
+# state broadcasts sit in the transport instead of stalling the sender
+WS_WRITER_LIMIT = 1 << 20
+
+# Longest the 'connect' action waits for the given peer to answer before replying
+# (the hole punch itself spans 2s and keeps going in the background)
+PEER_CONNECT_TIMEOUT = 4.0
+
+# Winning lines as indices into the flat 9-cell board (cell = 3 * row + col)
+_LINES = (
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),  # Rows
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),  # Columns
+    (0, 4, 8), (2, 4, 6),             # Diagonals
+)
+# The same lines as bitmasks over a 9-bit board (bit = cell index)
+_LINE_MASKS = tuple(sum(1 << cell for cell in line) for line in _LINES)
+_FULL_BOARD = 0x1FF
+
+
+def _cell_index(row, col) -> Optional[int]:
+    """Board index of (row, col), or None if it isn't a square on the board"""
+    if type(row) is int and type(col) is int and 0 <= row < 3 and 0 <= col < 3:
+        return 3 * row + col
+    return None
+
+
+@dataclass(slots=True)
 class GameState:
-    board: list
+    board: tuple  # 9 cells, row-major; replaced (never mutated) so snapshots can share it
     players: dict  # {ip: name}
     current_turn: str  # IP of current player
     my_symbol: str
@@ -27,12 +76,49 @@ class GameState:
     my_ip: str
     my_name: str
     opponent_name: str
+    x_mask: int = 0  # Cells holding X, one bit per cell
+    o_mask: int = 0  # Cells holding O
+    
+    def place(self, cell: int, symbol: str):
+        """Put a symbol on the board"""
+        self.board = self.board[:cell] + (symbol,) + self.board[cell + 1:]
+        if symbol == 'X':
+            self.x_mask |= 1 << cell
+        elif symbol == 'O':
+            self.o_mask |= 1 << cell
+    
+    def set_board(self, board):
+        """Replace the whole board (e.g. from the host's state) and rebuild the masks"""
+        self.board = tuple(board)
+        self.x_mask = self.o_mask = 0
+        for cell, symbol in enumerate(self.board):
+            if symbol == 'X':
+                self.x_mask |= 1 << cell
+            elif symbol == 'O':
+                self.o_mask |= 1 << cell
+    
+    def to_dict(self) -> dict:
+        """Shallow dict for JSON (unlike asdict, no recursive copy of board/players)"""
+        return {
+            'board': self.board,
+            'players': self.players,
+            'current_turn': self.current_turn,
+            'my_symbol': self.my_symbol,
+            'opponent_symbol': self.opponent_symbol,
+            'game_started': self.game_started,
+            'game_over': self.game_over,
+            'winner': self.winner,
+            'is_host': self.is_host,
+            'my_ip': self.my_ip,
+            'my_name': self.my_name,
+            'opponent_name': self.opponent_name,
+        }
 
 
 class WebGame:
     def __init__(self):
         self.mesh: Optional[MeshNetwork] = None
-        self.websockets: Set[web.WebSocketResponse] = set()
+        self.websockets: Dict[web.WebSocketResponse, asyncio.Queue] = {}  # ws -> outbound messages
         self.game_state: Optional[GameState] = None
         self.pending_invite_from: Optional[str] = None
         self.pending_invite_name: Optional[str] = None
@@ -40,11 +126,22 @@ class WebGame:
         self.player_name: str = "Player"
         self.known_peers: dict = {}  # {ip: name}
         self.connected_peers: set = set()  # Track unique connected peers
+        self._state_version = 0  # Bumped on every game_state mutation
+        self._state_cache: Optional[Tuple[int, bytes]] = None  # (version, game_state JSON)
+        self._flush_scheduled = False  # A coalesced broadcast_state() is queued on the loop
+        self._peers_cache: Optional[list] = None  # peers_snapshot(), rebuilt after peer changes
+        
+        self._mesh_handlers = {
+            'game_invite': self._on_game_invite,
+            'game_accept': self._on_game_accept,
+            'game_state': self._on_game_state,
+            'game_move': self._on_game_move,
+        }
         
     def reset_game(self):
         """Reset the game state"""
         self.game_state = GameState(
-            board=[['' for _ in range(3)] for _ in range(3)],
+            board=('',) * 9,
             players={},
             current_turn='',
             my_symbol='',
@@ -57,141 +154,206 @@ class WebGame:
             my_name=self.player_name,
             opponent_name=''
         )
+        self.mark_state_changed()
+        
+    def peer_entry(self, peer) -> dict:
+        """Web UI description of a mesh peer"""
+        ip = peer.virtual_ip
+        return {
+            'ip': ip,
+            'name': self.known_peers.get(ip) or f"Player-{ip.split('.')[-1]}",
+            'external': f"{peer.external_ip}:{peer.external_port}"
+        }
+        
+    def peers_snapshot(self) -> list:
+        """Peer list for the web UI, cached until a peer joins, leaves or is renamed"""
+        if self._peers_cache is None:
+            self._peers_cache = [self.peer_entry(p) for p in self.mesh.get_peers()] if self.mesh else []
+        return self._peers_cache
+        
+    def invalidate_peers(self):
+        self._peers_cache = None
+        
+    def mark_state_changed(self):
+        """Invalidate the cached game_state JSON after mutating game_state"""
+        self._state_version += 1
+        
+    def state_changed(self):
+        """Mark game_state mutated and broadcast it to web clients once the current
+        burst of updates is handled, so back-to-back changes go out as one message"""
+        self.mark_state_changed()
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_state)
+        
+    def _flush_state(self):
+        self._flush_scheduled = False
+        asyncio.create_task(self.broadcast_state())
+        
+    async def broadcast_state(self):
+        """Send game_state to all web clients, encoding it once per version"""
+        if not self.websockets:
+            return
+        if self._state_cache is None or self._state_cache[0] != self._state_version:
+            message = _dumps({'type': 'game_state', 'state': self.game_state.to_dict()})
+            self._state_cache = (self._state_version, message)
+        await self._send_to_web(self._state_cache[1])
         
     async def broadcast_to_web(self, msg_type: str, data: dict):
         """Send message to all connected web clients"""
-        message = json.dumps({'type': msg_type, **data})
-        dead_sockets = set()
-        for ws in self.websockets:
-            try:
-                await ws.send_str(message)
-            except:
-                dead_sockets.add(ws)
-        self.websockets -= dead_sockets
+        if not self.websockets:  # Headless play: skip the encode
+            return
+        await self._send_to_web(_dumps({'type': msg_type, **data}))
         
-    def handle_mesh_message(self, from_ip: str, data):
+    async def _send_to_web(self, message: bytes):
+        """Queue an encoded message for all connected web clients"""
+        # Each client's sender task does the actual send, so a slow socket never holds up the rest
+        for ws in list(self.websockets):
+            self.send_to_client(ws, message)
+            
+    def send_to_client(self, ws: web.WebSocketResponse, message: bytes):
+        """Queue an encoded message for one web client"""
+        queue = self.websockets.get(ws)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too far behind to catch up: disconnect rather than buffer without bound
+            del self.websockets[ws]
+            asyncio.create_task(ws.close())
+            
+    async def web_sender(self, ws: web.WebSocketResponse, queue: asyncio.Queue):
+        """Send one web client's queued messages in order until a send fails"""
+        try:
+            while True:
+                await ws.send_bytes(await queue.get())
+        except Exception:
+            self.websockets.pop(ws, None)
+        
+    async def handle_mesh_message(self, from_ip: str, data):
         """Handle messages from mesh network"""
         print(f"[MESH] From {from_ip}: {data}")
         
         if not isinstance(data, dict):
             return
-            
-        msg_type = data.get('msg_type')
         
         # Store peer name if provided
-        if 'player_name' in data:
-            self.known_peers[from_ip] = data['player_name']
+        name = data.get('player_name')
+        if name is not None and self.known_peers.get(from_ip) != name:
+            self.known_peers[from_ip] = name
+            self.invalidate_peers()
         
-        if msg_type == 'game_invite':
-            self.pending_invite_from = from_ip
-            self.pending_invite_name = data.get('player_name', 'Unknown')
-            self.host_ip = from_ip
-            asyncio.create_task(self.broadcast_to_web('invite', {
-                'from': from_ip,
-                'name': self.pending_invite_name,
-                'game': data.get('game_type')
-            }))
+        handler = self._mesh_handlers.get(data.get('msg_type'))
+        if handler:
+            await handler(from_ip, data)
             
-        elif msg_type == 'game_accept':
-            # Someone accepted our invite
-            if self.game_state and self.game_state.is_host:
-                opponent_name = data.get('player_name', 'Opponent')
-                self.game_state.players[from_ip] = opponent_name
-                self.game_state.opponent_name = opponent_name
-                self.game_state.game_started = True
-                self.game_state.current_turn = self.mesh.virtual_ip  # Host (X) goes first
-                print(f"[GAME] Started! Host turn. current_turn={self.game_state.current_turn}")
-                asyncio.create_task(self.broadcast_to_web('game_state', {'state': asdict(self.game_state)}))
-                # Send state to opponent with their turn info
-                asyncio.create_task(self.send_game_state_to_opponent(from_ip))
-                
-        elif msg_type == 'game_state':
-            # Received state from host
+    async def _on_game_invite(self, from_ip: str, data: dict):
+        """Someone invited us to a game"""
+        self.pending_invite_from = from_ip
+        self.pending_invite_name = data.get('player_name', 'Unknown')
+        self.host_ip = from_ip
+        await self.broadcast_to_web('invite', {
+            'from': from_ip,
+            'name': self.pending_invite_name,
+            'game': data.get('game_type')
+        })
+        
+    async def _on_game_accept(self, from_ip: str, data: dict):
+        """Someone accepted our invite"""
+        gs = self.game_state
+        if gs and gs.is_host:
+            opponent_name = data.get('player_name', 'Opponent')
+            gs.players[from_ip] = opponent_name
+            gs.opponent_name = opponent_name
+            gs.game_started = True
+            gs.current_turn = self.mesh.virtual_ip  # Host (X) goes first
+            print(f"[GAME] Started! Host turn. current_turn={gs.current_turn}")
+            self.state_changed()
+            # Send state to opponent with their turn info
+            await self.send_game_state_to_opponent(from_ip)
+            
+    async def _on_game_state(self, from_ip: str, data: dict):
+        """Received state from host"""
+        gs = self.game_state
+        if gs:
             state_data = data.get('state', {})
-            if self.game_state:
-                self.game_state.board = state_data.get('board', self.game_state.board)
-                self.game_state.current_turn = state_data.get('current_turn', '')
-                self.game_state.game_started = state_data.get('game_started', False)
-                self.game_state.game_over = state_data.get('game_over', False)
-                self.game_state.winner = state_data.get('winner')
-                self.game_state.opponent_name = state_data.get('host_name', 'Host')
-                print(f"[STATE] Received. current_turn={self.game_state.current_turn}, my_ip={self.game_state.my_ip}")
-                asyncio.create_task(self.broadcast_to_web('game_state', {'state': asdict(self.game_state)}))
-                
-        elif msg_type == 'game_move':
-            # Opponent made a move
-            move = data.get('move', {})
-            row, col = move.get('row'), move.get('col')
-            if self.game_state and row is not None and col is not None:
-                # Opponent's symbol is opposite of mine
-                opponent_symbol = 'O' if self.game_state.my_symbol == 'X' else 'X'
-                self.game_state.board[row][col] = opponent_symbol
-                self.game_state.current_turn = self.mesh.virtual_ip  # Now it's my turn
-                
-                # Check for winner
-                winner = self.check_winner()
-                if winner:
-                    self.game_state.game_over = True
-                    self.game_state.winner = winner
-                elif self.is_draw():
-                    self.game_state.game_over = True
-                    self.game_state.winner = 'draw'
+            before = gs.to_dict()
+            gs.set_board(state_data.get('board', gs.board))
+            gs.current_turn = state_data.get('current_turn', '')
+            gs.game_started = state_data.get('game_started', False)
+            gs.game_over = state_data.get('game_over', False)
+            gs.winner = state_data.get('winner')
+            gs.opponent_name = state_data.get('host_name', 'Host')
+            print(f"[STATE] Received. current_turn={gs.current_turn}, my_ip={gs.my_ip}")
+            if gs.to_dict() != before:  # Host rebroadcasts are often repeats
+                self.state_changed()
                 
-                print(f"[MOVE] Opponent played {opponent_symbol} at ({row},{col}). My turn now.")
-                asyncio.create_task(self.broadcast_to_web('game_state', {'state': asdict(self.game_state)}))
-                    
+    async def _on_game_move(self, from_ip: str, data: dict):
+        """Opponent made a move"""
+        gs = self.game_state
+        move = data.get('move')
+        if not gs or not isinstance(move, dict):
+            return
+        row, col = move.get('row'), move.get('col')
+        cell = _cell_index(row, col)
+        # Ignore moves off the board or onto a taken square
+        if cell is not None and gs.board[cell] == '':
+            # Opponent's symbol is opposite of mine
+            opponent_symbol = 'O' if gs.my_symbol == 'X' else 'X'
+            gs.place(cell, opponent_symbol)
+            gs.current_turn = self.mesh.virtual_ip  # Now it's my turn
+            
+            # Check for winner
+            winner = self.check_winner()
+            if winner:
+                gs.game_over = True
+                gs.winner = winner
+            elif self.is_draw():
+                gs.game_over = True
+                gs.winner = 'draw'
+            
+            print(f"[MOVE] Opponent played {opponent_symbol} at ({row},{col}). My turn now.")
+            self.state_changed()
+            
+    def _state_payload(self) -> dict:
+        """Mesh message carrying the host's view of the game"""
+        return {
+            'game_type': 'tictactoe',
+            'msg_type': 'game_state',
+            'state': {
+                'board': self.game_state.board,
+                'current_turn': self.game_state.current_turn,
+                'game_started': self.game_state.game_started,
+                'game_over': self.game_state.game_over,
+                'winner': self.game_state.winner,
+                'host_name': self.player_name
+            }
+        }
+        
     async def send_game_state_to_opponent(self, opponent_ip: str):
         """Send game state to opponent"""
         if self.mesh and self.game_state:
-            await self.mesh.send(opponent_ip, {
-                'game_type': 'tictactoe',
-                'msg_type': 'game_state',
-                'state': {
-                    'board': self.game_state.board,
-                    'current_turn': self.game_state.current_turn,
-                    'game_started': self.game_state.game_started,
-                    'game_over': self.game_state.game_over,
-                    'winner': self.game_state.winner,
-                    'host_name': self.player_name
-                }
-            })
+            await self.mesh.send(opponent_ip, self._state_payload())
             
     async def send_game_state(self):
         """Broadcast game state to all peers"""
-        if self.mesh and self.game_state:
-            await self.mesh.broadcast({
-                'game_type': 'tictactoe',
-                'msg_type': 'game_state',
-                'state': {
-                    'board': self.game_state.board,
-                    'current_turn': self.game_state.current_turn,
-                    'game_started': self.game_state.game_started,
-                    'game_over': self.game_state.game_over,
-                    'winner': self.game_state.winner,
-                    'host_name': self.player_name
-                }
-            })
+        if self.mesh and self.game_state and self.mesh.peers:
+            await self.mesh.broadcast(self._state_payload())
             
     def check_winner(self) -> Optional[str]:
         """Check if there's a winner"""
-        board = self.game_state.board
-        lines = []
-        # Rows and columns
-        for i in range(3):
-            lines.append([board[i][0], board[i][1], board[i][2]])
-            lines.append([board[0][i], board[1][i], board[2][i]])
-        # Diagonals
-        lines.append([board[0][0], board[1][1], board[2][2]])
-        lines.append([board[0][2], board[1][1], board[2][0]])
-        
-        for line in lines:
-            if line[0] and line[0] == line[1] == line[2]:
-                return line[0]
+        x, o = self.game_state.x_mask, self.game_state.o_mask
+        for line in _LINE_MASKS:
+            if x & line == line:
+                return 'X'
+            if o & line == line:
+                return 'O'
         return None
         
     def is_draw(self) -> bool:
         """Check if game is a draw"""
-        return all(self.game_state.board[i][j] for i in range(3) for j in range(3))
+        return self.game_state.x_mask | self.game_state.o_mask == _FULL_BOARD
 
 
 game = WebGame()
@@ -199,30 +361,33 @@ game = WebGame()
 
 async def websocket_handler(request):
     """Handle WebSocket connections from web UI"""
-    ws = web.WebSocketResponse()
+    # No permessage-deflate: state messages are a few hundred bytes, and aiohttp would
+    # compress the same broadcast again for every client
+    ws = web.WebSocketResponse(writer_limit=WS_WRITER_LIMIT, compress=False)
     await ws.prepare(request)
-    game.websockets.add(ws)
+    queue = asyncio.Queue(maxsize=WEB_QUEUE_SIZE)
+    sender = asyncio.create_task(game.web_sender(ws, queue))
+    game.websockets[ws] = queue
     
     # Send initial state
-    peers = [{'ip': p.virtual_ip, 'name': game.known_peers.get(p.virtual_ip, f"Player-{p.virtual_ip.split('.')[-1]}"), 'external': f"{p.external_ip}:{p.external_port}"} 
-             for p in game.mesh.get_peers()] if game.mesh else []
-    await ws.send_str(json.dumps({
+    game.send_to_client(ws, _dumps({
         'type': 'init',
         'connected': game.mesh is not None,
         'my_ip': game.mesh.virtual_ip if game.mesh else '',
         'my_name': game.player_name,
         'external': f"{game.mesh.external_ip}:{game.mesh.external_port}" if game.mesh else '',
-        'peers': peers,
-        'state': asdict(game.game_state) if game.game_state else None
+        'peers': game.peers_snapshot(),
+        'state': game.game_state.to_dict() if game.game_state else None
     }))
     
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
-                data = json.loads(msg.data)
+                data = _loads(msg.data)
                 await handle_ws_message(ws, data)
     finally:
-        game.websockets.discard(ws)
+        game.websockets.pop(ws, None)
+        sender.cancel()
         
     return ws
 
@@ -238,22 +403,23 @@ async def handle_ws_message(ws: web.WebSocketResponse, data: dict):
         peer = data.get('peer')  # Optional: ip:port to connect to
         game.player_name = data.get('name', 'Player')
         
+        from mesh_network import MeshNetwork
         game.mesh = MeshNetwork(network, secret, 0)
         game.mesh.on_message = game.handle_mesh_message
         game.connected_peers = set()
+        game.invalidate_peers()
+        peer_ready = asyncio.Event()
         
         def on_peer_connected(p):
+            game.invalidate_peers()
+            peer_ready.set()
             # Only notify if this is a new peer
             if p.virtual_ip not in game.connected_peers:
                 game.connected_peers.add(p.virtual_ip)
-                peer_name = game.known_peers.get(p.virtual_ip, f"Player-{p.virtual_ip.split('.')[-1]}")
-                asyncio.create_task(game.broadcast_to_web('peer_connected', {
-                    'ip': p.virtual_ip, 
-                    'name': peer_name,
-                    'external': f"{p.external_ip}:{p.external_port}"
-                }))
+                asyncio.create_task(game.broadcast_to_web('peer_connected', game.peer_entry(p)))
         
         def on_peer_disconnected(p):
+            game.invalidate_peers()
             game.connected_peers.discard(p.virtual_ip)
             asyncio.create_task(game.broadcast_to_web('peer_disconnected', {'ip': p.virtual_ip}))
         
@@ -265,17 +431,19 @@ async def handle_ws_message(ws: web.WebSocketResponse, data: dict):
         
         if peer:
             ip, port = peer.split(':')
-            await game.mesh.connect_to_peer(ip, int(port))
-            await asyncio.sleep(2)
+            # Reply as soon as the peer answers instead of after the full hole punch + 2s
+            asyncio.create_task(game.mesh.connect_to_peer(ip, int(port)))
+            try:
+                await asyncio.wait_for(peer_ready.wait(), timeout=PEER_CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
             
-        peers = [{'ip': p.virtual_ip, 'name': game.known_peers.get(p.virtual_ip, f"Player-{p.virtual_ip.split('.')[-1]}"), 'external': f"{p.external_ip}:{p.external_port}"} 
-                 for p in game.mesh.get_peers()]
-        await ws.send_str(json.dumps({
+        game.send_to_client(ws, _dumps({
             'type': 'connected',
             'my_ip': game.mesh.virtual_ip,
             'my_name': game.player_name,
             'external': f"{game.mesh.external_ip}:{game.mesh.external_port}",
-            'peers': peers
+            'peers': game.peers_snapshot()
         }))
         
     elif action == 'start_game':
@@ -325,7 +493,7 @@ async def handle_ws_message(ws: web.WebSocketResponse, data: dict):
             })
             game.pending_invite_from = None
             game.pending_invite_name = None
-            await game.broadcast_to_web('game_state', {'state': asdict(game.game_state)})
+            game.state_changed()
             
     elif action == 'move':
         # Make a move
@@ -335,8 +503,9 @@ async def handle_ws_message(ws: web.WebSocketResponse, data: dict):
             print(f"[MOVE] Attempting move. is_my_turn={is_my_turn}, current_turn={game.game_state.current_turn}, my_ip={game.mesh.virtual_ip}")
             
             if is_my_turn:
-                if game.game_state.board[row][col] == '':
-                    game.game_state.board[row][col] = game.game_state.my_symbol
+                cell = _cell_index(row, col)
+                if cell is not None and game.game_state.board[cell] == '':
+                    game.game_state.place(cell, game.game_state.my_symbol)
                     
                     # Determine opponent IP
                     peers = game.mesh.get_peers()
@@ -369,7 +538,7 @@ async def handle_ws_message(ws: web.WebSocketResponse, data: dict):
                             game.game_state.current_turn = opponent_ip
                             print(f"[MOVE] Switched turn to opponent: {opponent_ip}")
                             
-                    await game.broadcast_to_web('game_state', {'state': asdict(game.game_state)})
+                    game.state_changed()
                     
                     # If host, also send state update
                     if game.game_state.is_host and opponent_ip:
@@ -395,4 +564,5 @@ async def init_app():
 if __name__ == '__main__':
     print("🎮 Starting P2P Game Web Server...")
     print("📱 Open http://localhost:8080 in your browser")
-    web.run_app(init_app(), host='0.0.0.0', port=8080)
+    loop = uvloop.new_event_loop() if uvloop else None
+    web.run_app(init_app(), host='0.0.0.0', port=8080, loop=loop)